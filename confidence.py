@@ -22,9 +22,7 @@ class ConfidenceAnalyzer:
         Returns:
             Analysis dictionary with statistics and warnings
         """
-        scores = list(confidence_scores.values())
-        
-        if not scores:
+        if not confidence_scores:
             return {
                 "average_confidence": 0.0,
                 "min_confidence": 0.0,
@@ -34,35 +32,39 @@ class ConfidenceAnalyzer:
                 "high_confidence_fields": [],
             }
         
-        avg_confidence = sum(scores) / len(scores)
-        min_confidence = min(scores)
-        max_confidence = max(scores)
-        
-        low_confidence = [
-            (col, score)
-            for col, score in confidence_scores.items()
-            if score < LOW_CONFIDENCE_THRESHOLD
-        ]
-        
-        medium_confidence = [
-            (col, score)
-            for col, score in confidence_scores.items()
-            if LOW_CONFIDENCE_THRESHOLD <= score < MEDIUM_CONFIDENCE_THRESHOLD
-        ]
+        # Single pass: accumulate statistics and bucket each field
+        total = 0.0
+        min_confidence = float("inf")
+        max_confidence = float("-inf")
+        low_confidence = []
+        medium_confidence = []
+        high_confidence = []
+        
+        for col, score in confidence_scores.items():
+            total += score
+            if score < min_confidence:
+                min_confidence = score
+            if score > max_confidence:
+                max_confidence = score
+            
+            if score < LOW_CONFIDENCE_THRESHOLD:
+                low_confidence.append((col, score))
+            elif score < MEDIUM_CONFIDENCE_THRESHOLD:
+                medium_confidence.append((col, score))
+            else:
+                high_confidence.append((col, score))
         
-        high_confidence = [
-            (col, score)
-            for col, score in confidence_scores.items()
-            if score >= MEDIUM_CONFIDENCE_THRESHOLD
-        ]
+        avg_confidence = total / len(confidence_scores)
         
         return {
-            "average_confidence": round(avg_confidence, 3),
-            "min_confidence": round(min_confidence, 3),
-            "max_confidence": round(max_confidence, 3),
+            # Raw floats; rounding happens where the values are rendered
+            "average_confidence": avg_confidence,
+            "min_confidence": min_confidence,
+            "max_confidence": max_confidence,
             "low_confidence_fields": sorted(low_confidence, key=lambda x: x[1]),
             "medium_confidence_fields": sorted(medium_confidence, key=lambda x: x[1]),
-            "high_confidence_fields": sorted(high_confidence, key=lambda x: x[1]),
+            # Only low/medium are listed in score order; high is never ordered downstream
+            "high_confidence_fields": high_confidence,
         }
     
     @staticmethod
@@ -77,11 +79,14 @@ class ConfidenceAnalyzer:
         Returns:
             Formatted warning string
         """
-        warnings = []
-        
         low_fields = analysis["low_confidence_fields"]
         medium_fields = analysis["medium_confidence_fields"]
         
+        if not low_fields and not medium_fields:
+            return ""
+        
+        warnings = []
+        
         if low_fields:
             warnings.append(f"\n⚠️  LOW CONFIDENCE (< {LOW_CONFIDENCE_THRESHOLD}):")
             for col, score in low_fields:
@@ -92,40 +97,76 @@ class ConfidenceAnalyzer:
             for col, score in medium_fields:
                 warnings.append(f"   - {col}: {score:.2f}")
         
-        if warnings:
-            return f"\n📄 {invoice_name}\n" + "\n".join(warnings)
-        
-        return ""
+        return f"\n📄 {invoice_name}\n" + "\n".join(warnings)
     
     @staticmethod
-    def get_summary(all_analyses: List[Dict[str, Any]]) -> str:
+    def get_summary(totals: "ConfidenceTotals") -> str:
         """
         Generate summary statistics for all processed invoices.
         
         Args:
-            all_analyses: List of analysis dictionaries
+            totals: Running totals accumulated while processing
             
         Returns:
             Summary string
         """
-        if not all_analyses:
+        if not totals.count:
             return ""
         
-        avg_confidences = [a["average_confidence"] for a in all_analyses]
-        overall_avg = sum(avg_confidences) / len(avg_confidences)
-        
-        total_low = sum(len(a["low_confidence_fields"]) for a in all_analyses)
-        total_medium = sum(len(a["medium_confidence_fields"]) for a in all_analyses)
-        
         summary = [
             "\n" + "=" * 60,
             "CONFIDENCE SUMMARY",
             "=" * 60,
-            f"Total invoices processed: {len(all_analyses)}",
-            f"Overall average confidence: {overall_avg:.3f}",
-            f"Total low-confidence fields: {total_low}",
-            f"Total medium-confidence fields: {total_medium}",
+            f"Total invoices processed: {totals.count}",
+            f"Overall average confidence: {totals.average_confidence:.3f}",
+            f"Total low-confidence fields: {totals.low_fields}",
+            f"Total medium-confidence fields: {totals.medium_fields}",
             "=" * 60,
         ]
         
         return "\n".join(summary)
+
+
+class ConfidenceTotals:
+    """Running confidence totals, so per-invoice analyses need not be kept."""
+    
+    def __init__(self):
+        self.count = 0
+        self.confidence_sum = 0.0
+        self.low_fields = 0
+        self.medium_fields = 0
+        self.invoices: List[Dict[str, Any]] = []
+    
+    def add(self, invoice_name: str, analysis: Dict[str, Any]) -> None:
+        """
+        Fold one invoice's analysis into the totals.
+        
+        Args:
+            invoice_name: Name of the invoice file
+            analysis: Analysis dictionary from analyze_row
+        """
+        low = len(analysis["low_confidence_fields"])
+        medium = len(analysis["medium_confidence_fields"])
+        
+        self.count += 1
+        self.confidence_sum += analysis["average_confidence"]
+        self.low_fields += low
+        self.medium_fields += medium
+        
+        # One compact entry per invoice for the summary JSON
+        self.invoices.append({
+            "invoice": invoice_name,
+            "average_confidence": round(analysis["average_confidence"], 3),
+            "low_confidence_fields": low,
+            "medium_confidence_fields": medium,
+        })
+    
+    @property
+    def average_confidence(self) -> float:
+        """Mean of the per-invoice average confidences."""
+        return self.confidence_sum / self.count if self.count else 0.0
+    
+    @property
+    def has_warnings(self) -> bool:
+        """Whether any invoice had low or medium confidence fields."""
+        return bool(self.low_fields or self.medium_fields)
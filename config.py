@@ -8,29 +8,66 @@ from dotenv import load_dotenv
 # Load environment variables
 load_dotenv()
 
+
 # OpenAI Configuration
-OPENAI_API_KEY = os.getenv("OPENAI_API_KEY")
-if not OPENAI_API_KEY:
-    raise ValueError(
-        "OPENAI_API_KEY not found in environment variables. "
-        "Please create a .env file with your OpenAI API key."
-    )
+def get_openai_api_key() -> str:
+    """
+    Return the OpenAI API key from the environment.
+    
+    Checked when the OpenAI client is created rather than at import, so
+    --help and code that never calls the API work without a .env file.
+    """
+    api_key = os.getenv("OPENAI_API_KEY")
+    if not api_key:
+        raise ValueError(
+            "OPENAI_API_KEY not found in environment variables. "
+            "Please create a .env file with your OpenAI API key."
+        )
+    return api_key
+
 
 # Model Configuration
 DEFAULT_MODEL = "gpt-4o-mini"      # Cheapest model for most operations
 VISION_MODEL = "gpt-4o"            # Required for images (mini doesn't support vision)
 TEXT_MODEL = "gpt-4o-mini"         # Cheapest for text/PDF extraction
+SCHEMA_MODEL = "gpt-4o"            # Template schema inference (once per template, cached)
+EXTRACTION_MODEL = "gpt-4o"        # Invoice extraction, text and vision (keys the extraction cache)
 
 # Project Paths
 PROJECT_ROOT = Path(__file__).parent
 OUTPUT_DIR = PROJECT_ROOT / "output"
 OUTPUT_DIR.mkdir(exist_ok=True)
 OUTPUT_FILE = OUTPUT_DIR / "final_output.csv"
+EXTRACTION_CACHE_DIR = OUTPUT_DIR / ".extract_cache"
+EXTRACTION_CACHE_MIN_SECONDS = 0.25  # Only persist extractions slower than this
+EXTRACTION_MEMORY_CACHE_SIZE = 512
+SCHEMA_CACHE_PATH = OUTPUT_DIR / ".schema_cache.sqlite3"
+KNOWN_TEMPLATES_PATH = PROJECT_ROOT / "known_templates.json"  # Bundled schemas; no API call
+ENCODED_IMAGE_CACHE_SIZE = 32  # Base64 images kept in memory (each ~1.33x the file)
+
+# Image invoices larger than this are downscaled and re-encoded as JPEG
+# before upload (needs Pillow); the Vision API downscales to ~2048px anyway
+IMAGE_DOWNSCALE_MIN_BYTES = 1_000_000
+IMAGE_MAX_SIDE = 2048
+IMAGE_JPEG_QUALITY = 85
+
+# PDFs whose text layer is at least this long (and looks like an invoice) skip Vision
+MIN_INVOICE_TEXT_LENGTH = 20
 
-# Supported file extensions
-SUPPORTED_IMAGE_EXTENSIONS = {".png", ".jpg", ".jpeg", ".PNG", ".JPG", ".JPEG"}
-SUPPORTED_PDF_EXTENSIONS = {".pdf", ".PDF"}
-SUPPORTED_TEXT_EXTENSIONS = {".txt", ".TXT"}
+# Scanned PDFs: pages rendered for the Vision API (caps memory and image tokens)
+PDF_MAX_PAGES = 5
+PDF_RENDER_ZOOM = 2.0  # Higher resolution for better OCR
+PDF_MAX_RENDER_SIDE = 2048  # Pixels; the Vision API downscales anything larger
+
+# CSV output buffering (bytes buffered before each write syscall)
+CSV_WRITE_BUFFER_SIZE = 4 * 1024 * 1024
+CSV_CHUNK_SIZE = 1000  # Rows handed to the writer per batch
+
+# Supported file extensions (lowercase; compare against suffix.lower())
+SUPPORTED_IMAGE_EXTENSIONS = frozenset({".png", ".jpg", ".jpeg"})
+IMAGE_MIME_TYPES = {".png": "image/png", ".jpg": "image/jpeg", ".jpeg": "image/jpeg"}
+SUPPORTED_PDF_EXTENSIONS = frozenset({".pdf"})
+SUPPORTED_TEXT_EXTENSIONS = frozenset({".txt"})
 SUPPORTED_EXTENSIONS = (
     SUPPORTED_IMAGE_EXTENSIONS | SUPPORTED_PDF_EXTENSIONS | SUPPORTED_TEXT_EXTENSIONS
 )
@@ -41,4 +78,14 @@ MEDIUM_CONFIDENCE_THRESHOLD = 0.85
 
 # API Configuration
 MAX_RETRIES = 3
+RESPONSE_CACHE_SIZE = 1024  # Identical temperature-0 requests answered from memory (0 disables)
+JSON_REPAIR_RETRIES = 2  # Re-asks after a reply that is not valid JSON
 REQUEST_TIMEOUT = 60
+HTTP_MAX_CONNECTIONS = 64  # Pooled connections shared by all worker threads
+HTTP_MAX_KEEPALIVE_CONNECTIONS = 32
+MAX_CONCURRENCY = 8  # Invoices processed in parallel
+STREAM_EXTRACTIONS = True  # Stream extraction replies (per-chunk timeout, early JSON check)
+
+# Batch API Configuration (--batch)
+BATCH_COMPLETION_WINDOW = "24h"
+BATCH_POLL_INTERVAL = 30  # Seconds between batch status checks
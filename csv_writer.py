@@ -1,25 +1,37 @@
 """
 CSV writer for generating final output file.
 """
-import pandas as pd
+import csv
 import time
 import os
+from itertools import chain, islice
 from pathlib import Path
-from typing import List, Dict, Any
-from config import OUTPUT_FILE
+from typing import List, Dict, Any, Iterable, Iterator, Sequence
+from config import OUTPUT_FILE, CSV_WRITE_BUFFER_SIZE, CSV_CHUNK_SIZE
 
 
 class CSVWriter:
     """Write mapped invoice data to CSV file."""
     
-    def __init__(self, output_path: Path = None):
+    def __init__(
+        self,
+        output_path: Path = None,
+        use_pandas: bool = False,
+        chunk_size: int = CSV_CHUNK_SIZE,
+    ):
         """
         Initialize CSV writer.
         
         Args:
             output_path: Path to output CSV file (defaults to config.OUTPUT_FILE)
+            use_pandas: Write through a pandas DataFrame instead of the csv module
+            chunk_size: Number of rows written per batch
         """
+        if chunk_size < 1:
+            raise ValueError("chunk_size must be at least 1")
         self.output_path = output_path or OUTPUT_FILE
+        self.use_pandas = use_pandas
+        self.chunk_size = chunk_size
     
     def write(
         self,
@@ -41,57 +53,8 @@ class CSVWriter:
         if not rows:
             raise ValueError("No rows to write")
         
-        # Ensure all rows have all headers
-        normalized_rows = []
-        for row in rows:
-            normalized_row = {}
-            for header in headers:
-                normalized_row[header] = row.get(header, None)
-            normalized_rows.append(normalized_row)
-        
-        # Create DataFrame
-        df = pd.DataFrame(normalized_rows, columns=headers)
-        
-        # Write to CSV with retry logic for locked files
-        self.output_path.parent.mkdir(parents=True, exist_ok=True)
-        
-        # Try to write with retries (in case file is open in Excel)
-        max_retries = 3
-        retry_delay = 1
-        
-        for attempt in range(max_retries):
-            try:
-                # If file exists and might be locked, try to remove it first
-                if attempt > 0 and self.output_path.exists():
-                    try:
-                        os.remove(self.output_path)
-                    except PermissionError:
-                        # File is locked, wait and try again
-                        if attempt < max_retries - 1:
-                            print(f"   ⚠️  File is locked (may be open in Excel). Retrying in {retry_delay} second(s)...")
-                            time.sleep(retry_delay)
-                            retry_delay *= 2
-                            continue
-                
-                df.to_csv(self.output_path, index=False, encoding="utf-8")
-                break
-                
-            except PermissionError as e:
-                if attempt < max_retries - 1:
-                    print(f"   ⚠️  Permission denied. Retrying in {retry_delay} second(s)...")
-                    print(f"   💡 Please close the file if it's open in Excel or another program.")
-                    time.sleep(retry_delay)
-                    retry_delay *= 2
-                else:
-                    # Last attempt failed, try with timestamp backup
-                    timestamp = int(time.time())
-                    backup_path = self.output_path.parent / f"final_output_{timestamp}.csv"
-                    print(f"   ⚠️  Could not write to {self.output_path.name}")
-                    print(f"   💾 Writing to backup file: {backup_path.name}")
-                    df.to_csv(backup_path, index=False, encoding="utf-8")
-                    return backup_path
-        
-        return self.output_path
+        # Tuples in header order straight into csv.writer; no per-row dict is built
+        return self._write_atomic(headers, (tuple(map(row.get, headers)) for row in rows))
     
     def write_with_confidence(
         self,
@@ -113,61 +76,181 @@ class CSVWriter:
         if len(rows) != len(confidence_scores):
             raise ValueError("Rows and confidence scores must have same length")
         
-        # Create extended headers with confidence columns
-        extended_headers = []
-        for header in headers:
-            extended_headers.append(header)
-            extended_headers.append(f"{header}_confidence")
-        
-        # Create extended rows
-        extended_rows = []
-        for row, scores in zip(rows, confidence_scores):
-            extended_row = {}
-            for header in headers:
-                extended_row[header] = row.get(header, None)
-                extended_row[f"{header}_confidence"] = scores.get(header, 0.0)
-            extended_rows.append(extended_row)
-        
-        # Create DataFrame
-        df = pd.DataFrame(extended_rows, columns=extended_headers)
-        
-        # Write to CSV with retry logic for locked files
+        # Create extended headers with confidence columns (built once, not per row)
+        conf_headers = [f"{header}_confidence" for header in headers]
+        extended_headers = list(chain.from_iterable(zip(headers, conf_headers)))
+        
+        def extended_rows() -> Iterator[List[Any]]:
+            for row, scores in zip(rows, confidence_scores):
+                yield [
+                    value
+                    for header in headers
+                    for value in (row.get(header), scores.get(header, 0.0))
+                ]
+        
+        return self._write_atomic(extended_headers, extended_rows())
+    
+    def open_stream(self, headers: List[str]) -> "CSVRowStream":
+        """
+        Open the output for rows written one at a time as invoices finish.
+        
+        Always uses the csv module, even when use_pandas is set.
+        
+        Args:
+            headers: List of CSV column headers
+            
+        Returns:
+            CSVRowStream; call close() to move the finished file into place
+        """
+        return CSVRowStream(self, headers)
+    
+    def _write_atomic(self, headers: List[str], rows: Iterable[Sequence[Any]]) -> Path:
+        """
+        Write rows to a temp file beside the output and rename it into place.
+        
+        os.replace is atomic, so readers never see a half-written CSV. If the
+        target is locked (e.g. open in Excel) the temp file is renamed to a
+        timestamped backup instead of waiting for the lock to clear.
+        
+        Args:
+            headers: Column headers
+            rows: Iterable of row value sequences in header order
+            
+        Returns:
+            Path to written CSV file (a timestamped backup if the target is locked)
+        """
+        tmp_path = self._tmp_path()
+        
+        try:
+            self._write_rows(tmp_path, headers, rows)
+        except BaseException:
+            tmp_path.unlink(missing_ok=True)
+            raise
+        
+        return self._replace(tmp_path)
+    
+    def _tmp_path(self) -> Path:
+        """Return the temp file path beside the output, creating its directory."""
         self.output_path.parent.mkdir(parents=True, exist_ok=True)
+        return self.output_path.with_suffix(self.output_path.suffix + ".tmp")
+    
+    def _replace(self, tmp_path: Path) -> Path:
+        """
+        Rename a finished temp file over the output.
         
-        # Try to write with retries (in case file is open in Excel)
-        max_retries = 3
-        retry_delay = 1
-        
-        for attempt in range(max_retries):
-            try:
-                # If file exists and might be locked, try to remove it first
-                if attempt > 0 and self.output_path.exists():
-                    try:
-                        os.remove(self.output_path)
-                    except PermissionError:
-                        # File is locked, wait and try again
-                        if attempt < max_retries - 1:
-                            print(f"   ⚠️  File is locked (may be open in Excel). Retrying in {retry_delay} second(s)...")
-                            time.sleep(retry_delay)
-                            retry_delay *= 2
-                            continue
-                
-                df.to_csv(self.output_path, index=False, encoding="utf-8")
-                break
-                
-            except PermissionError as e:
-                if attempt < max_retries - 1:
-                    print(f"   ⚠️  Permission denied. Retrying in {retry_delay} second(s)...")
-                    print(f"   💡 Please close the file if it's open in Excel or another program.")
-                    time.sleep(retry_delay)
-                    retry_delay *= 2
-                else:
-                    # Last attempt failed, try with timestamp backup
-                    timestamp = int(time.time())
-                    backup_path = self.output_path.parent / f"final_output_{timestamp}.csv"
-                    print(f"   ⚠️  Could not write to {self.output_path.name}")
-                    print(f"   💾 Writing to backup file: {backup_path.name}")
-                    df.to_csv(backup_path, index=False, encoding="utf-8")
-                    return backup_path
-        
-        return self.output_path
+        Args:
+            tmp_path: Fully written temp file from _tmp_path
+            
+        Returns:
+            Path to written CSV file (a timestamped backup if the target is locked)
+        """
+        try:
+            os.replace(tmp_path, self.output_path)
+            return self.output_path
+        except PermissionError:
+            timestamp = int(time.time())
+            backup_path = self.output_path.parent / f"{self.output_path.stem}_{timestamp}.csv"
+            print(f"   ⚠️  Could not write to {self.output_path.name} (may be open in Excel)")
+            print(f"   💾 Writing to backup file: {backup_path.name}")
+            os.replace(tmp_path, backup_path)
+            return backup_path
+    
+    def _write_rows(
+        self, path: Path, headers: List[str], rows: Iterable[Sequence[Any]]
+    ) -> None:
+        """
+        Write a header row followed by data rows to a CSV file.
+        
+        Rows are consumed in chunks of ``chunk_size`` so only one chunk is
+        materialized at a time.
+        
+        Args:
+            path: Destination CSV file
+            headers: Column headers
+            rows: Iterable of row value sequences in header order
+        """
+        rows_iter = iter(rows)
+        
+        if self.use_pandas:
+            # Imported lazily: pandas is slow to import and only this opt-in path needs it
+            import pandas as pd
+            
+            # One DataFrame per chunk, appended after the first
+            first = True
+            for chunk in self._chunks(rows_iter):
+                df = pd.DataFrame(chunk, columns=headers)
+                df.to_csv(
+                    path,
+                    mode="w" if first else "a",
+                    header=first,
+                    index=False,
+                    encoding="utf-8",
+                )
+                first = False
+            if first:
+                pd.DataFrame(columns=headers).to_csv(path, index=False, encoding="utf-8")
+            return
+        
+        # One large buffer, flushed only on close - never per row
+        with open(
+            path, "w", newline="", encoding="utf-8", buffering=CSV_WRITE_BUFFER_SIZE
+        ) as f:
+            # Same line endings pandas' to_csv used to produce
+            writer = csv.writer(f, lineterminator=os.linesep)
+            writer.writerow(headers)
+            for chunk in self._chunks(rows_iter):
+                writer.writerows(chunk)
+    
+    def _chunks(self, rows_iter: Iterator[Sequence[Any]]) -> Iterator[List[Sequence[Any]]]:
+        """Yield successive lists of at most chunk_size rows."""
+        while True:
+            chunk = list(islice(rows_iter, self.chunk_size))
+            if not chunk:
+                return
+            yield chunk
+
+
+class CSVRowStream:
+    """
+    CSV output written row by row to a temp file and renamed into place on close.
+    
+    Each row is flushed as it is written, so rows are not held in memory and
+    an interrupted run leaves every completed row in the ``.tmp`` file beside
+    the output.
+    """
+    
+    def __init__(self, writer: CSVWriter, headers: List[str]):
+        """
+        Create the temp file and write the header row.
+        
+        Args:
+            writer: CSVWriter that owns the output path
+            headers: List of CSV column headers
+        """
+        self._writer = writer
+        self.headers = headers
+        self.row_count = 0
+        self._tmp_path = writer._tmp_path()
+        self._file = open(self._tmp_path, "w", newline="", encoding="utf-8")
+        # Same line endings pandas' to_csv used to produce
+        self._csv = csv.writer(self._file, lineterminator=os.linesep)
+        self._csv.writerow(headers)
+    
+    def writerow(self, row: Dict[str, Any]) -> None:
+        """Write one mapped row in header order and flush it to disk."""
+        self._csv.writerow(tuple(map(row.get, self.headers)))
+        self._file.flush()
+        self.row_count += 1
+    
+    def close(self) -> Path:
+        """
+        Close the temp file and move it over the output.
+        
+        Returns:
+            Path to written CSV file (a timestamped backup if the target is locked)
+        """
+        self._file.close()
+        if self.row_count == 0:
+            self._tmp_path.unlink(missing_ok=True)
+            raise ValueError("No rows to write")
+        return self._writer._replace(self._tmp_path)
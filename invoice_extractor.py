@@ -1,149 +1,66 @@
 """
 Invoice data extractor using OpenAI Vision and text models.
 """
-import json
+import base64
+import hashlib
+import os
+import tempfile
+import threading
+import time
+from collections import OrderedDict
+from datetime import datetime, timezone
+from concurrent.futures import FIRST_COMPLETED, Future, ThreadPoolExecutor, as_completed, wait
 from pathlib import Path
-from typing import Dict, Any, Optional, Tuple
-from openai_client import OpenAIClient
-from utils import get_file_type, encode_image, read_text_file, read_pdf_file
+from typing import Dict, Any, Iterator, List, Optional, Tuple, Union
+from config import (
+    EXTRACTION_CACHE_DIR,
+    EXTRACTION_CACHE_MIN_SECONDS,
+    EXTRACTION_MEMORY_CACHE_SIZE,
+    EXTRACTION_MODEL,
+    JSON_REPAIR_RETRIES,
+    MAX_CONCURRENCY,
+    PDF_MAX_PAGES,
+    PDF_RENDER_ZOOM,
+    PDF_MAX_RENDER_SIDE,
+    STREAM_EXTRACTIONS,
+)
+from mapper import format_schema_description
+from openai_client import NonJSONReplyError, OpenAIClient
+from utils import (
+    get_file_type,
+    encode_image_for_vision,
+    read_text_file,
+    read_pdf_file,
+    looks_like_invoice_text,
+    json_dumps,
+    json_loads,
+)
 
+# Bump whenever the extraction prompts change so cached results are invalidated
+PROMPT_VERSION = "v4"
 
-class InvoiceExtractor:
-    """Extract structured data from invoice documents using OpenAI."""
-    
-    def __init__(self, openai_client: OpenAIClient):
-        """Initialize invoice extractor with OpenAI client."""
-        self.client = openai_client
-    
-    def extract(self, file_path: Path) -> tuple[Dict[str, Any], Dict[str, Any]]:
-        """
-        Extract invoice data from a document file.
-        
-        Args:
-            file_path: Path to invoice file (PDF, image, or text)
-            
-        Returns:
-            Tuple of (extracted_data, api_usage)
-        """
-        file_type = get_file_type(file_path)
-        
-        if file_type == "image":
-            return self._extract_from_image(file_path)
-        elif file_type == "pdf":
-            return self._extract_from_pdf(file_path)
-        elif file_type == "text":
-            return self._extract_from_text(file_path)
-        else:
-            raise ValueError(f"Unsupported file type: {file_type}")
-    
-    def _extract_from_image(self, image_path: Path) -> Tuple[Dict[str, Any], Dict[str, Any]]:
-        """Extract data from image invoice using Vision API."""
-        prompt = """Analyze this invoice image and extract all relevant invoice data.
+try:
+    import fitz  # PyMuPDF; only needed for image-based PDFs
+except ImportError:
+    fitz = None
 
-Extract the following information (if available):
-- Invoice number
-- Invoice date
-- Due date
-- Vendor/supplier name
-- Vendor address
-- Customer/buyer name
-- Customer address
-- Line items (description, quantity, unit price, total)
-- Subtotal
-- Tax/VAT amount
-- Total amount
-- Payment terms
-- Currency
-- Any other relevant invoice fields
+# Serializes PyMuPDF calls across worker threads
+_FITZ_LOCK = threading.Lock()
+_ZOOM_MATRIX = fitz.Matrix(PDF_RENDER_ZOOM, PDF_RENDER_ZOOM) if fitz else None
 
-Return the extracted data as a JSON object with this structure:
-{
-  "invoice_number": "value or null",
-  "invoice_date": "value or null",
-  "due_date": "value or null",
-  "vendor_name": "value or null",
-  "vendor_address": "value or null",
-  "customer_name": "value or null",
-  "customer_address": "value or null",
-  "line_items": [
-    {
-      "description": "value",
-      "quantity": "value or null",
-      "unit_price": "value or null",
-      "total": "value or null"
-    }
-  ],
-  "subtotal": "value or null",
-  "tax_amount": "value or null",
-  "total_amount": "value or null",
-  "currency": "value or null",
-  "payment_terms": "value or null",
-  "additional_fields": {
-    "field_name": "value"
-  }
-}
+_IMAGE_PROMPT = """Analyze this invoice image and extract all relevant invoice data.
 
-Be thorough and extract all visible information. Use null for missing fields."""
+Return a JSON object with these keys, using null for anything not visible:
+- invoice_number, invoice_date, due_date
+- vendor_name, vendor_address, customer_name, customer_address
+- line_items: array of objects with description, quantity, unit_price, total
+- subtotal, tax_amount, total_amount, currency, payment_terms
+- additional_fields: object holding any other relevant invoice fields by name
 
-        response = self.client.vision_completion(
-            image_path=image_path,
-            prompt=prompt,
-            max_tokens=4096,
-        )
-        
-        extracted_data = self.client.parse_json_response(response)
-        api_usage = response.get("usage", {})
-        
-        return extracted_data, api_usage
-    
-    def _extract_from_pdf(self, pdf_path: Path) -> Tuple[Dict[str, Any], Dict[str, Any]]:
-        """Extract data from PDF invoice."""
-        # First, try to extract text from PDF
-        try:
-            text_content = read_pdf_file(pdf_path)
-        except Exception as e:
-            print(f"   ⚠️  Text extraction failed: {str(e)}")
-            text_content = ""
-        
-        # Check if we got meaningful text (more than just whitespace)
-        if text_content and len(text_content.strip()) > 50:
-            # Use text model to extract structured data
-            return self._extract_from_text_content(text_content)
-        else:
-            # PDF is likely image-based (scanned), use Vision API
-            print("   📸 PDF appears to be image-based, using Vision API...")
-            return self._extract_from_pdf_images(pdf_path)
-    
-    def _extract_from_pdf_images(self, pdf_path: Path) -> Tuple[Dict[str, Any], Dict[str, Any]]:
-        """Extract data from image-based PDF by converting to images."""
-        try:
-            import fitz  # PyMuPDF
-            import tempfile
-            from PIL import Image
-            
-            # Open PDF
-            doc = fitz.open(pdf_path)
-            
-            if len(doc) == 0:
-                raise ValueError("PDF has no pages")
-            
-            # Convert first page to image (usually invoice is on first page)
-            page = doc[0]
-            zoom = 2.0  # Higher resolution for better OCR
-            mat = fitz.Matrix(zoom, zoom)
-            pix = page.get_pixmap(matrix=mat)
-            
-            # Save as temporary PNG
-            with tempfile.NamedTemporaryFile(suffix='.png', delete=False) as tmp_file:
-                temp_image_path = Path(tmp_file.name)
-                img = Image.frombytes("RGB", [pix.width, pix.height], pix.samples)
-                img.save(temp_image_path, 'PNG')
-            
-            doc.close()
-            
-            try:
-                # Use Vision API to extract data (same prompt as image extraction)
-                prompt = """Analyze this invoice image and extract all relevant invoice data.
+Be thorough and extract all visible information."""
+
+# Same fields as the image prompt, plus GST fields
+_PDF_IMAGE_PROMPT = """Analyze this invoice image and extract all relevant invoice data.
 
 Extract the following information (if available):
 - Invoice number
@@ -197,41 +114,7 @@ Return the extracted data as a JSON object with this structure:
 
 Be thorough and extract all visible information. Use null for missing fields."""
 
-                response = self.client.vision_completion(
-                    image_path=temp_image_path,
-                    prompt=prompt,
-                    max_tokens=4096,
-                )
-                
-                extracted_data = self.client.parse_json_response(response)
-                api_usage = response.get("usage", {})
-                
-                return extracted_data, api_usage
-            finally:
-                # Clean up temporary image file
-                if temp_image_path.exists():
-                    temp_image_path.unlink()
-                    
-        except ImportError:
-            raise ValueError(
-                "PDF appears to be image-based but PyMuPDF is not installed. "
-                "Install it with: pip install pymupdf pillow"
-            )
-        except Exception as e:
-            raise ValueError(f"Failed to process PDF as image: {str(e)}")
-    
-    def _extract_from_text(self, text_path: Path) -> Tuple[Dict[str, Any], Dict[str, Any]]:
-        """Extract data from text invoice file."""
-        text_content = read_text_file(text_path)
-        
-        if not text_content or not text_content.strip():
-            raise ValueError("Text file appears to be empty")
-        
-        return self._extract_from_text_content(text_content)
-    
-    def _extract_from_text_content(self, text_content: str) -> Tuple[Dict[str, Any], Dict[str, Any]]:
-        """Extract structured data from text content using GPT."""
-        system_prompt = """You are an expert invoice data extractor. Your task is to analyze invoice text and extract all relevant structured data.
+_SYSTEM_PROMPT = """You are an expert invoice data extractor. Your task is to analyze invoice text and extract all relevant structured data.
 
 Extract comprehensive invoice information including:
 - Invoice number, dates, vendor/customer information
@@ -241,13 +124,9 @@ Extract comprehensive invoice information including:
 - Any other relevant fields
 
 Return structured JSON with all extracted information."""
-        
-        user_prompt = f"""Extract all invoice data from this text:
-
-{text_content}
 
-Return the extracted data as a JSON object with this structure:
-{{
+_USER_PROMPT_SUFFIX = """Return the extracted data as a JSON object with this structure:
+{
   "invoice_number": "value or null",
   "invoice_date": "value or null",
   "due_date": "value or null",
@@ -256,37 +135,617 @@ Return the extracted data as a JSON object with this structure:
   "customer_name": "value or null",
   "customer_address": "value or null",
   "line_items": [
-    {{
+    {
       "description": "value",
       "quantity": "value or null",
       "unit_price": "value or null",
       "total": "value or null"
-    }}
+    }
   ],
   "subtotal": "value or null",
   "tax_amount": "value or null",
   "total_amount": "value or null",
   "currency": "value or null",
   "payment_terms": "value or null",
-  "additional_fields": {{
+  "additional_fields": {
     "field_name": "value"
-  }}
-}}
+  }
+}
 
 Extract all available information. Use null for missing fields."""
+
+# Single-call mode: extract straight into the CSV template's columns
+_FUSED_SYSTEM_PROMPT = """You are an expert invoice data extractor. Read the invoice and fill in each CSV column below by semantic meaning, not exact string matching.
+
+For every column return the value (null if the invoice does not contain it) and a confidence score from 0.0 to 1.0:
+- 1.0: Perfect match, exact field found
+- 0.8-0.9: Strong semantic match
+- 0.6-0.7: Reasonable match with some inference
+- 0.4-0.5: Weak match, significant inference
+- 0.0-0.3: No match found, null value
+
+Aggregate line items if a column needs it (e.g., sum quantities, concatenate descriptions).
+
+CSV SCHEMA:
+"""
+
+
+class ExtractionCache:
+    """
+    Content-addressable store of extraction results.
+    
+    Entries live in an in-memory LRU backed by one JSON file per key on
+    disk, so re-running on unchanged invoices skips the OpenAI call.
+    """
+    
+    def __init__(self, cache_dir: Path, memory_size: int = EXTRACTION_MEMORY_CACHE_SIZE):
+        """
+        Initialize the cache.
+        
+        Args:
+            cache_dir: Directory holding <key>.json entries
+            memory_size: Maximum number of entries kept in memory
+        """
+        self.cache_dir = cache_dir
+        self.memory_size = memory_size
+        self._memory: "OrderedDict[str, Dict[str, Any]]" = OrderedDict()
+        self._lock = threading.Lock()
+    
+    @staticmethod
+    def make_key(file_path: Path, variant: str = "") -> str:
+        """
+        Hash file content together with everything that shapes the output.
+        
+        Each part is prefixed with its 8-byte length so no two different
+        part sequences can produce the same byte stream.
+        
+        Args:
+            file_path: Path to invoice file
+            variant: Extra request shape to key on (e.g. the target schema)
+            
+        Returns:
+            Hex sha256 digest
+        """
+        hasher = hashlib.sha256()
+        for part in (
+            EXTRACTION_MODEL.encode("utf-8"),
+            PROMPT_VERSION.encode("utf-8"),
+            variant.encode("utf-8"),
+            file_path.read_bytes(),
+        ):
+            hasher.update(len(part).to_bytes(8, "big"))
+            hasher.update(part)
+        return hasher.hexdigest()
+    
+    def get(self, key: str) -> Optional[Dict[str, Any]]:
+        """
+        Look up an extraction, checking memory before disk.
+        
+        Args:
+            key: Cache key from make_key
+            
+        Returns:
+            Cached extraction data, or None on a miss or unreadable entry
+        """
+        with self._lock:
+            extracted_data = self._memory.get(key)
+            if extracted_data is not None:
+                self._memory.move_to_end(key)
+                return extracted_data
+        
+        try:
+            extracted_data = json_loads(
+                (self.cache_dir / f"{key}.json").read_bytes()
+            )["extraction_data"]
+        except (OSError, ValueError, KeyError):
+            return None
+        
+        self._remember(key, extracted_data)
+        return extracted_data
+    
+    def put(
+        self,
+        key: str,
+        extracted_data: Dict[str, Any],
+        api_usage: Dict[str, Any],
+        persist: bool = True,
+    ) -> None:
+        """
+        Store an extraction in memory and, optionally, on disk.
+        
+        Args:
+            key: Cache key from make_key
+            extracted_data: Extracted invoice data
+            api_usage: Token usage of the call that produced it
+            persist: Whether to write the entry to disk as well
+        """
+        self._remember(key, extracted_data)
+        if not persist:
+            return
+        
+        # Written atomically so concurrent readers never see a partial file
+        self.cache_dir.mkdir(parents=True, exist_ok=True)
+        with tempfile.NamedTemporaryFile(
+            "wb", dir=self.cache_dir, suffix=".tmp", delete=False
+        ) as tmp_file:
+            tmp_file.write(json_dumps({
+                "extraction_data": extracted_data,
+                "api_usage": api_usage,
+                "cached_at": datetime.now(timezone.utc).isoformat(),
+            }))
+        os.replace(tmp_file.name, self.cache_dir / f"{key}.json")
+    
+    def _remember(self, key: str, extracted_data: Dict[str, Any]) -> None:
+        """Add an entry to the in-memory LRU, evicting the oldest one."""
+        with self._lock:
+            self._memory[key] = extracted_data
+            self._memory.move_to_end(key)
+            if len(self._memory) > self.memory_size:
+                self._memory.popitem(last=False)
+
+
+class InvoiceExtractor:
+    """Extract structured data from invoice documents using OpenAI."""
+    
+    def __init__(
+        self,
+        openai_client: OpenAIClient,
+        cache_dir: Optional[Path] = EXTRACTION_CACHE_DIR,
+        schema: Optional[List[Dict[str, Any]]] = None,
+    ):
+        """
+        Initialize invoice extractor with OpenAI client.
+        
+        Args:
+            openai_client: OpenAI client wrapper
+            cache_dir: Directory for cached extraction results (None disables caching)
+            schema: CSV schema to extract straight into (single-call mode). Results
+                are then {"mapped_data", "confidence_scores"} for
+                SemanticMapper.normalize_mapping instead of generic invoice data
+        """
+        self.client = openai_client
+        self.cache = ExtractionCache(cache_dir) if cache_dir is not None else None
+        self.schema = schema
+        self._fused_system_prompt = None
+        self._fused_response_format = None
+        self._cache_variant = ""
+        
+        if schema is not None:
+            self._fused_system_prompt = _FUSED_SYSTEM_PROMPT + format_schema_description(schema)
+            self._fused_response_format = self._build_fused_response_format(
+                [col["header"] for col in schema]
+            )
+            self._cache_variant = self._fused_system_prompt
+    
+    def extract(self, file_path: Path) -> tuple[Dict[str, Any], Dict[str, Any]]:
+        """
+        Extract invoice data from a document file.
+        
+        Results are cached keyed by file content, so re-running on an
+        unchanged invoice does not call OpenAI again. Every result is kept in
+        an in-memory LRU; only extractions that took longer than
+        EXTRACTION_CACHE_MIN_SECONDS are persisted to disk.
+        
+        Args:
+            file_path: Path to invoice file (PDF, image, or text)
+            
+        Returns:
+            Tuple of (extracted_data, api_usage)
+        """
+        return self._extract_prepared(self._prepare(file_path))
+    
+    def iter_extract(
+        self, file_paths: List[Path], max_concurrency: int = MAX_CONCURRENCY
+    ) -> Iterator[Tuple[int, Union[Tuple[Dict[str, Any], Dict[str, Any]], Exception]]]:
+        """
+        Extract several invoices concurrently, yielding each as it finishes.
+        
+        Runs as a two-stage pipeline: a parse pool reads files (cache lookup,
+        PDF text, image encoding) while an API pool sends the prepared
+        payloads to OpenAI, so parsing overlaps the network wait of earlier
+        invoices. A failure in one file does not affect the others.
+        
+        Args:
+            file_paths: Paths to invoice files
+            max_concurrency: Maximum number of extractions in flight
+            
+        Yields:
+            (index into file_paths, (extracted_data, api_usage) or the
+            exception raised for that file), in completion order
+        """
+        # Bound how far parsing runs ahead so prepared payloads (encoded
+        # images, PDF text) don't pile up in memory on large batches. The
+        # window is enforced here, in submission order, so no worker ever
+        # blocks waiting for room
+        window = 2 * max_concurrency
+        
+        def complete(prepared: Future) -> Tuple[Dict[str, Any], Dict[str, Any]]:
+            return self._extract_prepared(prepared.result())
+        
+        def outcome(future: Future) -> Union[Tuple[Dict[str, Any], Dict[str, Any]], Exception]:
+            try:
+                return future.result()
+            except Exception as e:
+                return e
+        
+        with ThreadPoolExecutor(max_workers=os.cpu_count() or 1) as parse_pool, \
+                ThreadPoolExecutor(max_workers=max_concurrency) as api_pool:
+            in_flight: Dict[Future, int] = {}
+            for index, file_path in enumerate(file_paths):
+                while len(in_flight) >= window:
+                    done, _ = wait(in_flight, return_when=FIRST_COMPLETED)
+                    for future in done:
+                        yield in_flight.pop(future), outcome(future)
+                
+                prepared = parse_pool.submit(self._prepare, file_path)
+                in_flight[api_pool.submit(complete, prepared)] = index
+            
+            for future in as_completed(in_flight):
+                yield in_flight[future], outcome(future)
+    
+    def _prepare(self, file_path: Path) -> Dict[str, Any]:
+        """
+        Run the local half of extraction: cache lookup and file parsing.
+        
+        Args:
+            file_path: Path to invoice file (PDF, image, or text)
+            
+        Returns:
+            Payload for _extract_prepared holding either the cached result,
+            an encoded image and its prompt, or the invoice text
+        """
+        cache_key = None
+        if self.cache is not None:
+            cache_key = ExtractionCache.make_key(file_path, self._cache_variant)
+            extracted_data = self.cache.get(cache_key)
+            if extracted_data is not None:
+                return {"cache_key": cache_key, "cached": extracted_data}
+        
+        file_type = get_file_type(file_path)
+        
+        if file_type == "image":
+            base64_image, mime_type = encode_image_for_vision(file_path)
+            payload = {"image": base64_image, "prompt": _IMAGE_PROMPT, "mime_type": mime_type}
+        elif file_type == "pdf":
+            payload = self._prepare_pdf(file_path)
+        elif file_type == "text":
+            payload = {"text": self._read_text(file_path)}
+        else:
+            raise ValueError(f"Unsupported file type: {file_type}")
+        
+        payload["cache_key"] = cache_key
+        return payload
+    
+    def _extract_prepared(self, payload: Dict[str, Any]) -> Tuple[Dict[str, Any], Dict[str, Any]]:
+        """Run the network half of extraction on a payload from _prepare."""
+        if "cached" in payload:
+            # No tokens are spent on a cache hit
+            api_usage = {"prompt_tokens": 0, "completion_tokens": 0, "total_tokens": 0, "cached": True}
+            return payload["cached"], api_usage
+        
+        start = time.perf_counter()
+        extracted_data, api_usage = self._call_with_retry(self._build_request(payload))
+        elapsed = time.perf_counter() - start
+        
+        self._remember(payload["cache_key"], extracted_data, api_usage, elapsed)
+        return extracted_data, self._with_warnings(api_usage, payload)
+    
+    def _call_with_retry(
+        self, request: Dict[str, Any], max_retries: int = JSON_REPAIR_RETRIES
+    ) -> Tuple[Dict[str, Any], Dict[str, Any]]:
+        """
+        Send a request and parse its JSON reply, asking the model to fix bad output.
+        
+        A reply that does not parse is kept in the conversation and followed
+        by the parse error, so the model corrects its own output instead of
+        the invoice being dropped.
+        
+        Args:
+            request: Request body from _build_request
+            max_retries: Follow-up attempts after the first malformed reply
+            
+        Returns:
+            Tuple of (extracted_data, api_usage) with usage summed over attempts
+        """
+        messages = list(request["messages"])
+        api_usage = {"prompt_tokens": 0, "completion_tokens": 0, "total_tokens": 0}
+        
+        for attempt in range(max_retries + 1):
+            try:
+                response = self.client.chat_completion(
+                    **{**request, "messages": messages}, stream=STREAM_EXTRACTIONS
+                )
+            except NonJSONReplyError as e:
+                # The stream was cut off at its first tokens; repair from those
+                if attempt == max_retries:
+                    raise
+                content, error = e.content, str(e)
+            else:
+                for key in api_usage:
+                    api_usage[key] += response.get("usage", {}).get(key, 0)
+                
+                try:
+                    extracted_data = self.client.parse_json_response(response)
+                    if not isinstance(extracted_data, dict):
+                        raise ValueError("Expected a JSON object at the top level")
+                    if attempt == 0 and response.get("usage", {}).get("cached"):
+                        api_usage["cached"] = True
+                    return extracted_data, api_usage
+                except ValueError as e:
+                    if attempt == max_retries:
+                        raise
+                    content = response.get("content") or ""
+                    error = str(e).split("\n", 1)[0]
+            
+            messages += [
+                {"role": "assistant", "content": content},
+                {
+                    "role": "user",
+                    "content": f"Your output had an error: {error}. "
+                               "Fix it and return only valid JSON.",
+                },
+            ]
+            time.sleep(1.0 * (attempt + 1))
+    
+    def extract_with_batch_api(
+        self, file_paths: List[Path]
+    ) -> List[Union[Tuple[Dict[str, Any], Dict[str, Any]], Exception]]:
+        """
+        Extract invoices through the OpenAI Batch API.
+        
+        Cached invoices are answered locally; the rest are submitted as one
+        batch and this call blocks until OpenAI finishes it.
+        
+        Args:
+            file_paths: Paths to invoice files
+            
+        Returns:
+            List aligned with file_paths holding (extracted_data, api_usage)
+            or the exception raised for that file
+        """
+        results: List[Any] = [None] * len(file_paths)
+        pending: Dict[str, Dict[str, Any]] = {}
+        
+        for index, file_path in enumerate(file_paths):
+            try:
+                payload = self._prepare(file_path)
+            except Exception as e:
+                results[index] = e
+                continue
+            if "cached" in payload:
+                results[index] = self._extract_prepared(payload)
+            else:
+                pending[str(index)] = payload
+        
+        if not pending:
+            return results
+        
+        try:
+            responses = self.client.run_batch(
+                {custom_id: self._build_request(payload) for custom_id, payload in pending.items()}
+            )
+        except Exception as e:
+            for custom_id in pending:
+                results[int(custom_id)] = e
+            return results
+        
+        for custom_id, payload in pending.items():
+            response = responses[custom_id]
+            try:
+                if isinstance(response, Exception):
+                    raise response
+                extracted_data = self.client.parse_json_response(response)
+            except Exception as e:
+                results[int(custom_id)] = e
+                continue
+            
+            api_usage = response.get("usage", {})
+            # Batch results took minutes to produce; always worth persisting
+            self._remember(payload["cache_key"], extracted_data, api_usage, float("inf"))
+            results[int(custom_id)] = (extracted_data, self._with_warnings(api_usage, payload))
+        
+        return results
+    
+    def _build_request(self, payload: Dict[str, Any]) -> Dict[str, Any]:
+        """Build the chat completion request body for a prepared payload."""
+        if self.schema is not None:
+            return self._build_fused_request(payload)
+        
+        if "image" in payload:
+            return self.client.build_request_body(
+                messages=self.client.build_vision_messages(
+                    payload["prompt"],
+                    payload["image"],
+                    payload["mime_type"],
+                    payload.get("detail"),
+                ),
+                model=EXTRACTION_MODEL,
+                response_format={"type": "json_object"},
+                max_tokens=4096,
+            )
+        
+        user_prompt = (
+            f"Extract all invoice data from this text:\n\n{payload['text']}\n\n"
+            + _USER_PROMPT_SUFFIX
+        )
         
         messages = [
-            {"role": "system", "content": system_prompt},
+            {"role": "system", "content": _SYSTEM_PROMPT},
             {"role": "user", "content": user_prompt},
         ]
         
-        response = self.client.chat_completion(
+        return self.client.build_request_body(
             messages=messages,
+            model=EXTRACTION_MODEL,
             response_format={"type": "json_object"},
             temperature=0.0,
         )
+    
+    def _build_fused_request(self, payload: Dict[str, Any]) -> Dict[str, Any]:
+        """Build a request that extracts a payload straight into the schema columns."""
+        if "image" in payload:
+            messages = self.client.build_vision_messages(
+                "Fill in the CSV columns from this invoice.",
+                payload["image"],
+                payload["mime_type"],
+                payload.get("detail"),
+            )
+        else:
+            messages = [{
+                "role": "user",
+                "content": f"Fill in the CSV columns from this invoice text:\n\n{payload['text']}",
+            }]
+        
+        return self.client.build_request_body(
+            messages=[{"role": "system", "content": self._fused_system_prompt}] + messages,
+            model=EXTRACTION_MODEL,
+            response_format=self._fused_response_format,
+            temperature=0.0,
+            max_tokens=4096,
+        )
+    
+    @staticmethod
+    def _build_fused_response_format(headers: List[str]) -> Dict[str, Any]:
+        """Structured-output JSON schema with one value and one score per header."""
+        def columns(value_schema: Dict[str, Any]) -> Dict[str, Any]:
+            return {
+                "type": "object",
+                "properties": {header: value_schema for header in headers},
+                "required": headers,
+                "additionalProperties": False,
+            }
+        
+        return {
+            "type": "json_schema",
+            "json_schema": {
+                "name": "invoice_row",
+                "strict": True,
+                "schema": {
+                    "type": "object",
+                    "properties": {
+                        "mapped_data": columns({"type": ["string", "number", "null"]}),
+                        "confidence_scores": columns({"type": "number"}),
+                    },
+                    "required": ["mapped_data", "confidence_scores"],
+                    "additionalProperties": False,
+                },
+            },
+        }
+    
+    def _remember(
+        self,
+        cache_key: Optional[str],
+        extracted_data: Dict[str, Any],
+        api_usage: Dict[str, Any],
+        elapsed: float,
+    ) -> None:
+        """Cache a fresh extraction in memory, and on disk if it was slow to produce."""
+        if cache_key is None:
+            return
+        self.cache.put(
+            cache_key,
+            extracted_data,
+            api_usage,
+            persist=elapsed > EXTRACTION_CACHE_MIN_SECONDS,
+        )
+    
+    @staticmethod
+    def _with_warnings(api_usage: Dict[str, Any], payload: Dict[str, Any]) -> Dict[str, Any]:
+        """Attach notices raised while parsing a payload to its usage record."""
+        if not payload.get("warnings"):
+            return api_usage
+        return {**api_usage, "warnings": payload["warnings"]}
+    
+    def _prepare_pdf(self, pdf_path: Path) -> Dict[str, Any]:
+        """Read a PDF invoice as text, falling back to a rendered page image."""
+        # Parsing runs on a worker thread, so notices travel with the payload
+        # and are printed in the invoice's own report
+        warnings = []
+        
+        # First, try to extract text from PDF
+        try:
+            text_content = read_pdf_file(pdf_path)
+        except Exception as e:
+            warnings.append(f"⚠️  Text extraction failed: {str(e)}")
+            text_content = ""
+        
+        # Prefer the much cheaper text model whenever the text layer is usable
+        if text_content and looks_like_invoice_text(text_content):
+            # Use text model to extract structured data
+            return {"text": text_content, "warnings": warnings}
+        else:
+            # PDF is likely image-based (scanned), use Vision API
+            warnings.append("📸 PDF appears to be image-based, using Vision API...")
+            payload = self._prepare_pdf_images(pdf_path)
+            payload["warnings"] = warnings + payload["warnings"]
+            return payload
+    
+    def _prepare_pdf_images(self, pdf_path: Path) -> Dict[str, Any]:
+        """Render the pages of an image-based PDF to encoded PNGs for the Vision API."""
+        if fitz is None:
+            raise ValueError(
+                "PDF appears to be image-based but PyMuPDF is not installed. "
+                "Install it with: pip install pymupdf"
+            )
+        
+        try:
+            # PyMuPDF is not thread-safe; parsing runs on a thread pool, so
+            # pages are rendered one after another under the lock
+            with _FITZ_LOCK:
+                doc = fitz.open(pdf_path)
+                try:
+                    if len(doc) == 0:
+                        raise ValueError("PDF has no pages")
+                    
+                    warnings = []
+                    if len(doc) > PDF_MAX_PAGES:
+                        warnings.append(f"⚠️  Only the first {PDF_MAX_PAGES} of {len(doc)} pages will be sent")
+                    
+                    # PNG bytes straight from PyMuPDF; no PIL copy or temp file
+                    base64_images = [
+                        base64.b64encode(
+                            doc[page_number].get_pixmap(
+                                matrix=self._page_matrix(doc[page_number])
+                            ).tobytes("png")
+                        ).decode("utf-8")
+                        for page_number in range(min(len(doc), PDF_MAX_PAGES))
+                    ]
+                finally:
+                    doc.close()
+            
+            # "high" so the endpoint tiles the page as rendered instead of rescaling it
+            return {
+                "image": base64_images,
+                "prompt": _PDF_IMAGE_PROMPT,
+                "mime_type": "image/png",
+                "detail": "high",
+                "warnings": warnings,
+            }
+                    
+        except Exception as e:
+            raise ValueError(f"Failed to process PDF as image: {str(e)}")
+    
+    @staticmethod
+    def _page_matrix(page) -> "fitz.Matrix":
+        """
+        Pick the render zoom for a page.
         
-        extracted_data = self.client.parse_json_response(response)
-        api_usage = response.get("usage", {})
+        Pages are rendered at PDF_RENDER_ZOOM unless that would make the
+        longer side exceed PDF_MAX_RENDER_SIDE pixels, the largest size the
+        Vision API uses at detail "high"; beyond it extra pixels only add
+        upload size.
+        """
+        longest_side = max(page.rect.width, page.rect.height)
+        if longest_side * PDF_RENDER_ZOOM <= PDF_MAX_RENDER_SIDE:
+            return _ZOOM_MATRIX
+        zoom = PDF_MAX_RENDER_SIDE / longest_side
+        return fitz.Matrix(zoom, zoom)
+    
+    def _read_text(self, text_path: Path) -> str:
+        """Read a text invoice file."""
+        text_content = read_text_file(text_path)
+        
+        if not text_content or not text_content.strip():
+            raise ValueError("Text file appears to be empty")
         
-        return extracted_data, api_usage
+        return text_content
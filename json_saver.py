@@ -2,29 +2,69 @@
 JSON data saver for OpenAI API responses and intermediate data.
 Saving JSON locally does NOT cost any additional tokens - it's just file I/O.
 """
-import json
+import threading
+from concurrent.futures import Future, ThreadPoolExecutor
 from pathlib import Path
-from typing import Dict, Any, List, Optional
+from typing import Dict, Any, List, Optional, Tuple
 from datetime import datetime
 from config import OUTPUT_DIR
+from utils import json_dumps
 
 
 class JSONSaver:
     """Save raw JSON data from OpenAI API responses."""
     
-    def __init__(self, output_dir: Path = None):
-        """Initialize JSON saver."""
+    def __init__(self, output_dir: Path = None, compact: bool = True):
+        """
+        Initialize JSON saver.
+        
+        Args:
+            output_dir: Directory for JSON files (defaults to OUTPUT_DIR/json_data)
+            compact: Default for extraction and mapping files, which only
+                programs read: write them without indentation. Schema and
+                summary files are always indented for people to read
+        """
         self.output_dir = output_dir or OUTPUT_DIR / "json_data"
+        self.compact = compact
         self.output_dir.mkdir(parents=True, exist_ok=True)
         self.session_id = datetime.now().strftime('%Y%m%d_%H%M%S')
         
+        # One background writer keeps per-invoice JSON I/O off the main loop
+        self._io_pool = ThreadPoolExecutor(max_workers=1, thread_name_prefix="json-saver")
+        self._pending: List[Future] = []
+        self._pending_lock = threading.Lock()
+    
     def save_extraction(
         self, 
         invoice_name: str, 
         raw_data: Dict[str, Any], 
-        api_usage: Optional[Dict[str, Any]] = None
+        api_usage: Optional[Dict[str, Any]] = None,
+        pretty: Optional[bool] = None
     ) -> Path:
         """Save raw extraction JSON from OpenAI."""
+        filepath, data = self._extraction_record(invoice_name, raw_data, api_usage)
+        self._write_json(filepath, data, pretty=self._pretty(pretty))
+        return filepath
+    
+    def save_extraction_async(
+        self,
+        invoice_name: str,
+        raw_data: Dict[str, Any],
+        api_usage: Optional[Dict[str, Any]] = None,
+        pretty: Optional[bool] = None
+    ) -> Path:
+        """Queue raw extraction JSON for the background writer; see wait()."""
+        filepath, data = self._extraction_record(invoice_name, raw_data, api_usage)
+        self._submit(filepath, data, pretty=self._pretty(pretty))
+        return filepath
+    
+    def _extraction_record(
+        self,
+        invoice_name: str,
+        raw_data: Dict[str, Any],
+        api_usage: Optional[Dict[str, Any]]
+    ) -> Tuple[Path, Dict[str, Any]]:
+        """Build the file path and JSON document for an extraction."""
         # Clean filename (remove extension, replace spaces)
         clean_name = Path(invoice_name).stem.replace(' ', '_')
         filename = f"extraction_{clean_name}_{self.session_id}.json"
@@ -37,19 +77,46 @@ class JSONSaver:
             "api_usage": api_usage or {}
         }
         
-        with open(filepath, 'w', encoding='utf-8') as f:
-            json.dump(data, f, indent=2, ensure_ascii=False)
-        
-        return filepath
+        return filepath, data
     
     def save_mapping(
         self, 
         invoice_name: str, 
         mapped_data: Dict[str, Any],
         confidence_scores: Dict[str, float], 
-        api_usage: Optional[Dict[str, Any]] = None
+        api_usage: Optional[Dict[str, Any]] = None,
+        pretty: Optional[bool] = None
     ) -> Path:
         """Save mapping JSON with confidence scores."""
+        filepath, data = self._mapping_record(
+            invoice_name, mapped_data, confidence_scores, api_usage
+        )
+        self._write_json(filepath, data, pretty=self._pretty(pretty))
+        return filepath
+    
+    def save_mapping_async(
+        self,
+        invoice_name: str,
+        mapped_data: Dict[str, Any],
+        confidence_scores: Dict[str, float],
+        api_usage: Optional[Dict[str, Any]] = None,
+        pretty: Optional[bool] = None
+    ) -> Path:
+        """Queue mapping JSON for the background writer; see wait()."""
+        filepath, data = self._mapping_record(
+            invoice_name, mapped_data, confidence_scores, api_usage
+        )
+        self._submit(filepath, data, pretty=self._pretty(pretty))
+        return filepath
+    
+    def _mapping_record(
+        self,
+        invoice_name: str,
+        mapped_data: Dict[str, Any],
+        confidence_scores: Dict[str, float],
+        api_usage: Optional[Dict[str, Any]]
+    ) -> Tuple[Path, Dict[str, Any]]:
+        """Build the file path and JSON document for a mapping."""
         clean_name = Path(invoice_name).stem.replace(' ', '_')
         filename = f"mapping_{clean_name}_{self.session_id}.json"
         filepath = self.output_dir / filename
@@ -62,10 +129,7 @@ class JSONSaver:
             "api_usage": api_usage or {}
         }
         
-        with open(filepath, 'w', encoding='utf-8') as f:
-            json.dump(data, f, indent=2, ensure_ascii=False)
-        
-        return filepath
+        return filepath, data
     
     def save_schema(
         self, 
@@ -82,8 +146,7 @@ class JSONSaver:
             "api_usage": api_usage or {}
         }
         
-        with open(filepath, 'w', encoding='utf-8') as f:
-            json.dump(data, f, indent=2, ensure_ascii=False)
+        self._write_json(filepath, data)
         
         return filepath
     
@@ -91,7 +154,7 @@ class JSONSaver:
         self, 
         all_invoices: List[str], 
         total_usage: Dict[str, Any],
-        all_analyses: List[Dict[str, Any]]
+        confidence_summary: List[Dict[str, Any]]
     ) -> Path:
         """Save summary of all processing."""
         filename = f"summary_{self.session_id}.json"
@@ -117,18 +180,45 @@ class JSONSaver:
                 "gpt_4o": round(cost_estimate_gpt4o, 6),
                 "note": "Actual costs depend on model used per call"
             },
-            "confidence_summary": [
-                {
-                    "invoice": inv,
-                    "average_confidence": analysis.get("average_confidence", 0),
-                    "low_confidence_fields": len(analysis.get("low_confidence_fields", [])),
-                    "medium_confidence_fields": len(analysis.get("medium_confidence_fields", []))
-                }
-                for inv, analysis in zip(all_invoices, all_analyses)
-            ]
+            "confidence_summary": confidence_summary
         }
         
-        with open(filepath, 'w', encoding='utf-8') as f:
-            json.dump(data, f, indent=2, ensure_ascii=False)
+        self._write_json(filepath, data)
         
         return filepath
+    
+    def wait(self) -> None:
+        """
+        Block until every queued write has finished.
+        
+        Raises:
+            The first exception raised by a queued write, after all have finished
+        """
+        with self._pending_lock:
+            pending, self._pending = self._pending, []
+        
+        errors = [future.exception() for future in pending]
+        for error in errors:
+            if error is not None:
+                raise error
+    
+    def close(self) -> None:
+        """Wait for queued writes and stop the background writer."""
+        try:
+            self.wait()
+        finally:
+            self._io_pool.shutdown(wait=True)
+    
+    def _pretty(self, pretty: Optional[bool]) -> bool:
+        """Resolve a per-call pretty flag against the saver's compact default."""
+        return not self.compact if pretty is None else pretty
+    
+    def _submit(self, filepath: Path, data: Dict[str, Any], pretty: bool) -> None:
+        """Queue a write on the background writer."""
+        future = self._io_pool.submit(self._write_json, filepath, data, pretty)
+        with self._pending_lock:
+            self._pending.append(future)
+    
+    def _write_json(self, filepath: Path, data: Dict[str, Any], pretty: bool = True) -> None:
+        """Encode data as UTF-8 JSON and write it to filepath."""
+        filepath.write_bytes(json_dumps(data, pretty=pretty))
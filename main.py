@@ -3,24 +3,20 @@ Main CLI entry point for invoice-to-CSV normalization application.
 """
 import sys
 import argparse
-import os
+import hashlib
+import io
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
 from typing import List, Dict, Any, Tuple, Optional
 
-# Fix encoding for Windows console
+# Fix encoding for Windows console (set the code page directly; no chcp subprocess)
 if sys.platform == "win32":
-    os.system("chcp 65001 >nul 2>&1")
+    if sys.stdout.isatty():
+        import ctypes
+        ctypes.windll.kernel32.SetConsoleOutputCP(65001)
     sys.stdout.reconfigure(encoding='utf-8') if hasattr(sys.stdout, 'reconfigure') else None
 
-from config import OUTPUT_FILE
-from openai_client import OpenAIClient
-from schema_parser import SchemaParser
-from invoice_extractor import InvoiceExtractor
-from mapper import SemanticMapper
-from confidence import ConfidenceAnalyzer
-from csv_writer import CSVWriter
-from json_saver import JSONSaver
-from utils import find_invoice_files, validate_csv_template
+from config import OUTPUT_FILE, MAX_CONCURRENCY, EXTRACTION_CACHE_DIR, SCHEMA_CACHE_PATH
 
 
 def get_user_input(prompt: str, validator=None) -> str:
@@ -50,7 +46,46 @@ def validate_path(path_str: str) -> Path:
     return path
 
 
-def main(template_path: Optional[str] = None, invoice_dir: Optional[str] = None, auto_confirm: bool = False):
+def dedupe_files(files: List[Path]) -> Tuple[List[Path], List[int]]:
+    """
+    Collapse byte-identical files so each distinct content is processed once.
+    
+    Args:
+        files: Paths to invoice files
+        
+    Returns:
+        Tuple of (unique_files, source_indices) where source_indices[i] is the
+        position in unique_files of the file with the same content as files[i]
+    """
+    unique_files = []
+    source_indices = []
+    first_index = {}
+    
+    for file_path in files:
+        try:
+            key = hashlib.sha256(file_path.read_bytes()).digest()
+        except OSError:
+            key = file_path  # Unreadable: let extraction report the error
+        
+        if key not in first_index:
+            first_index[key] = len(unique_files)
+            unique_files.append(file_path)
+        source_indices.append(first_index[key])
+    
+    return unique_files, source_indices
+
+
+def main(
+    template_path: Optional[str] = None,
+    invoice_dir: Optional[str] = None,
+    auto_confirm: bool = False,
+    use_batch: bool = False,
+    cache_dir: Optional[str] = None,
+    single_call: bool = False,
+    concurrency: int = MAX_CONCURRENCY,
+    invoices_per_call: int = 1,
+    no_cache: bool = False,
+):
     """Main CLI application flow."""
     print("=" * 60)
     print("🤖 AI-Powered Invoice-to-CSV Normalization")
@@ -58,9 +93,20 @@ def main(template_path: Optional[str] = None, invoice_dir: Optional[str] = None,
     print()
     
     try:
+        # Imported here rather than at module level so --help and argument
+        # errors return without loading openai and PyMuPDF
+        from openai_client import OpenAIClient
+        from schema_parser import SchemaParser
+        from invoice_extractor import InvoiceExtractor
+        from mapper import SemanticMapper
+        from confidence import ConfidenceAnalyzer, ConfidenceTotals
+        from csv_writer import CSVWriter
+        from json_saver import JSONSaver
+        from utils import SchemaCache, find_invoice_files, validate_csv_template
+        
         # Initialize OpenAI client
         print("🔧 Initializing OpenAI client...")
-        openai_client = OpenAIClient()
+        openai_client = OpenAIClient(max_in_flight=concurrency)
         print("✅ OpenAI client initialized")
         print()
         
@@ -115,10 +161,17 @@ def main(template_path: Optional[str] = None, invoice_dir: Optional[str] = None,
             print(f"Step 3: Auto-confirming processing of {len(invoice_files)} invoice(s)...")
             print()
         
+        # The Batch API can take hours to return, so it is only used unattended
+        if use_batch and not auto_confirm:
+            print("⚠️  --batch requires --yes; using regular API calls instead")
+            print()
+            use_batch = False
+        
         # Initialize components
         print("🔧 Initializing components...")
-        schema_parser = SchemaParser(openai_client)
-        invoice_extractor = InvoiceExtractor(openai_client)
+        schema_parser = SchemaParser(
+            openai_client, cache=None if no_cache else SchemaCache(SCHEMA_CACHE_PATH)
+        )
         mapper = SemanticMapper(openai_client)
         confidence_analyzer = ConfidenceAnalyzer()
         csv_writer = CSVWriter()
@@ -147,90 +200,179 @@ def main(template_path: Optional[str] = None, invoice_dir: Optional[str] = None,
         total_api_usage["total_prompt_tokens"] += schema_usage.get("prompt_tokens", 0)
         total_api_usage["total_completion_tokens"] += schema_usage.get("completion_tokens", 0)
         total_api_usage["total_tokens"] += schema_usage.get("total_tokens", 0)
-        total_api_usage["total_calls"] += 1
+        if schema_usage.get("known_template"):
+            print(f"📚 Matched known template: {schema_usage['known_template']}")
+        elif schema_usage.get("cached"):
+            print("♻️  Schema loaded from cache")
+        else:
+            total_api_usage["total_calls"] += 1
         
         print(f"✅ Template parsed: {len(headers)} columns")
         print(f"   Columns: {', '.join(headers)}")
         print()
         
+        # In single-call mode the extractor fills the template columns directly
+        invoice_extractor = InvoiceExtractor(
+            openai_client,
+            cache_dir=None if no_cache else Path(cache_dir or EXTRACTION_CACHE_DIR),
+            schema=schema if single_call else None,
+        )
+        
         # Process each invoice
         print("=" * 60)
         print("PROCESSING INVOICES")
         print("=" * 60)
         print()
         
-        all_rows = []
-        all_confidence_scores = []
-        all_analyses = []
+        confidence_totals = ConfidenceTotals()
         processed_invoices = []
         
-        for i, invoice_file in enumerate(invoice_files, 1):
-            print(f"[{i}/{len(invoice_files)}] Processing: {invoice_file.name}")
+        # Byte-identical files (e.g. a resent PDF) are extracted and mapped once
+        unique_files, source_indices = dedupe_files(invoice_files)
+        if len(unique_files) < len(invoice_files):
+            print(f"♻️  {len(invoice_files) - len(unique_files)} duplicate file(s) will reuse earlier results")
+        
+        extraction_results = [None] * len(unique_files)
+        mapping_results = [None] * len(unique_files)
+        
+        if use_batch:
+            print("📄 Extracting invoice data via the Batch API (this may take a while)...")
+            extraction_results = invoice_extractor.extract_with_batch_api(unique_files)
+        else:
+            # Each invoice goes to the mapping pool as soon as its own extraction
+            # finishes, so mapping overlaps the extractions still in flight
+            workers = min(concurrency, len(unique_files)) or 1
+            print(f"📄 Extracting invoice data ({workers} at a time)...")
+            with ThreadPoolExecutor(max_workers=workers) as map_pool:
+                mapping_futures = []
+                group = []
+                for index, extraction in invoice_extractor.iter_extract(unique_files, workers):
+                    extraction_results[index] = extraction
+                    if not single_call and not isinstance(extraction, Exception):
+                        group.append(index)
+                    if len(group) == invoices_per_call:
+                        mapping_futures.append((group, map_pool.submit(
+                            mapper.map_batch, [extraction_results[i][0] for i in group], schema
+                        )))
+                        group = []
+                if group:
+                    mapping_futures.append((group, map_pool.submit(
+                        mapper.map_batch, [extraction_results[i][0] for i in group], schema
+                    )))
+                for group, future in mapping_futures:
+                    for index, mapping in zip(group, future.result()):
+                        mapping_results[index] = mapping
+        
+        extracted_indices = [
+            index for index, result in enumerate(extraction_results)
+            if not isinstance(result, Exception)
+        ]
+        if single_call:
+            # Extraction already produced the mapping; only validate it
+            for index in extracted_indices:
+                try:
+                    mapped_data, confidence_scores = mapper.normalize_mapping(
+                        extraction_results[index][0], schema
+                    )
+                    mapping_results[index] = (mapped_data, confidence_scores, {})
+                except Exception as e:
+                    mapping_results[index] = e
+        elif use_batch:
+            print("🔗 Mapping to CSV schema via the Batch API...")
+            mapped = mapper.map_with_batch_api(
+                [extraction_results[index][0] for index in extracted_indices], schema
+            )
+            for index, mapping in zip(extracted_indices, mapped):
+                mapping_results[index] = mapping
+        print()
+        
+        # Rows go to disk as each invoice is reported instead of being collected
+        csv_stream = csv_writer.open_stream(headers)
+        
+        seen_sources = set()
+        for i, (invoice_file, source_index) in enumerate(zip(invoice_files, source_indices), 1):
+            # Each invoice's report is written to the console in one go
+            report = io.StringIO()
+            print(f"[{i}/{len(invoice_files)}] Processing: {invoice_file.name}", file=report)
+            extraction = extraction_results[source_index]
+            mapping = mapping_results[source_index]
+            
+            # A duplicate's tokens were already counted with its first copy
+            is_duplicate = source_index in seen_sources
+            seen_sources.add(source_index)
+            if is_duplicate:
+                print(f"   ♻️  Same content as {unique_files[source_index].name}, reusing its results", file=report)
             
             try:
-                # Extract invoice data
-                print("   📄 Extracting invoice data...")
-                invoice_data, extraction_usage = invoice_extractor.extract(invoice_file)
+                if isinstance(extraction, Exception):
+                    raise extraction
+                invoice_data, extraction_usage = extraction
                 
-                # Save extraction JSON
-                extraction_json_path = json_saver.save_extraction(
+                # Queue extraction JSON; written in the background
+                extraction_json_path = json_saver.save_extraction_async(
                     invoice_file.name,
                     invoice_data,
                     extraction_usage
                 )
                 
                 # Update total usage
-                total_api_usage["total_prompt_tokens"] += extraction_usage.get("prompt_tokens", 0)
-                total_api_usage["total_completion_tokens"] += extraction_usage.get("completion_tokens", 0)
-                total_api_usage["total_tokens"] += extraction_usage.get("total_tokens", 0)
-                total_api_usage["total_calls"] += 1
+                if not is_duplicate:
+                    for warning in extraction_usage.get("warnings", ()):
+                        print(f"   {warning}", file=report)
+                    total_api_usage["total_prompt_tokens"] += extraction_usage.get("prompt_tokens", 0)
+                    total_api_usage["total_completion_tokens"] += extraction_usage.get("completion_tokens", 0)
+                    total_api_usage["total_tokens"] += extraction_usage.get("total_tokens", 0)
+                    if extraction_usage.get("cached"):
+                        print("   ♻️  Extraction loaded from cache", file=report)
+                    else:
+                        total_api_usage["total_calls"] += 1
+                        print("   ✅ Extraction complete", file=report)
                 
-                print("   ✅ Extraction complete")
+                if isinstance(mapping, Exception):
+                    raise mapping
+                mapped_data, confidence_scores, mapping_usage = mapping
                 
-                # Map to schema
-                print("   🔗 Mapping to CSV schema...")
-                mapped_data, confidence_scores, mapping_usage = mapper.map_invoice_to_schema(
-                    invoice_data, schema
-                )
-                
-                # Save mapping JSON
-                mapping_json_path = json_saver.save_mapping(
+                # Queue mapping JSON; written in the background
+                mapping_json_path = json_saver.save_mapping_async(
                     invoice_file.name,
                     mapped_data,
                     confidence_scores,
                     mapping_usage
                 )
                 
-                # Update total usage
-                total_api_usage["total_prompt_tokens"] += mapping_usage.get("prompt_tokens", 0)
-                total_api_usage["total_completion_tokens"] += mapping_usage.get("completion_tokens", 0)
-                total_api_usage["total_tokens"] += mapping_usage.get("total_tokens", 0)
-                total_api_usage["total_calls"] += 1
+                # Update total usage (single-call mode has no separate mapping call)
+                if not single_call and not is_duplicate:
+                    total_api_usage["total_prompt_tokens"] += mapping_usage.get("prompt_tokens", 0)
+                    total_api_usage["total_completion_tokens"] += mapping_usage.get("completion_tokens", 0)
+                    total_api_usage["total_tokens"] += mapping_usage.get("total_tokens", 0)
+                    if not mapping_usage.get("shared_call") and not mapping_usage.get("cached"):
+                        total_api_usage["total_calls"] += 1
                 
-                print("   ✅ Mapping complete")
+                print("   ✅ Mapping complete", file=report)
                 
                 # Analyze confidence
                 analysis = confidence_analyzer.analyze_row(confidence_scores, mapped_data)
-                all_analyses.append(analysis)
+                confidence_totals.add(invoice_file.name, analysis)
                 
                 # Store results
-                all_rows.append(mapped_data)
-                all_confidence_scores.append(confidence_scores)
+                csv_stream.writerow(mapped_data)
                 processed_invoices.append(invoice_file.name)
                 
                 # Show warnings
                 warnings = confidence_analyzer.format_warnings(analysis, invoice_file.name)
                 if warnings:
-                    print(warnings)
+                    print(warnings, file=report)
                 
-                print(f"   📊 Average confidence: {analysis['average_confidence']:.3f}")
-                print()
+                print(f"   📊 Average confidence: {analysis['average_confidence']:.3f}", file=report)
+                print(file=report)
                 
             except Exception as e:
-                print(f"   ❌ Error processing {invoice_file.name}: {str(e)}")
-                print(f"   ⚠️  Skipping this invoice...")
-                print()
-                continue
+                print(f"   ❌ Error processing {invoice_file.name}: {str(e)}", file=report)
+                print(f"   ⚠️  Skipping this invoice...", file=report)
+                print(file=report)
+            finally:
+                sys.stdout.write(report.getvalue())
+                sys.stdout.flush()
         
         # Write output CSV
         print("=" * 60)
@@ -238,8 +380,11 @@ def main(template_path: Optional[str] = None, invoice_dir: Optional[str] = None,
         print("=" * 60)
         print()
         
-        print(f"📝 Writing {len(all_rows)} row(s) to CSV...")
-        output_path = csv_writer.write(headers, all_rows, all_confidence_scores)
+        # Flush queued extraction/mapping JSON before producing the final output
+        json_saver.wait()
+        
+        print(f"📝 Writing {csv_stream.row_count} row(s) to CSV...")
+        output_path = csv_stream.close()
         print(f"✅ Output written: {output_path}")
         print()
         
@@ -247,11 +392,13 @@ def main(template_path: Optional[str] = None, invoice_dir: Optional[str] = None,
         summary_json_path = json_saver.save_summary(
             processed_invoices,
             total_api_usage,
-            all_analyses
+            confidence_totals.invoices
         )
+        json_saver.close()
+        openai_client.close()
         
         # Show summary
-        summary = confidence_analyzer.get_summary(all_analyses)
+        summary = confidence_analyzer.get_summary(confidence_totals)
         if summary:
             print(summary)
             print()
@@ -275,12 +422,7 @@ def main(template_path: Optional[str] = None, invoice_dir: Optional[str] = None,
         print()
         
         # Show low confidence warnings
-        has_warnings = any(
-            len(a["low_confidence_fields"]) > 0 or len(a["medium_confidence_fields"]) > 0
-            for a in all_analyses
-        )
-        
-        if has_warnings:
+        if confidence_totals.has_warnings:
             print("⚠️  WARNING: Some fields have low or medium confidence scores.")
             print("   Please review the output CSV and verify low-confidence fields.")
             print()
@@ -311,6 +453,53 @@ if __name__ == "__main__":
     parser.add_argument("--template", "-t", type=str, help="Path to CSV template file")
     parser.add_argument("--invoices", "-i", type=str, help="Directory path containing invoice files")
     parser.add_argument("--yes", "-y", action="store_true", help="Auto-confirm processing without prompting")
+    parser.add_argument(
+        "--batch",
+        action="store_true",
+        help="Use the discounted OpenAI Batch API (requires --yes; results may take up to 24h)",
+    )
+    parser.add_argument(
+        "--cache-dir",
+        type=str,
+        help=f"Directory for cached extraction results (default: {EXTRACTION_CACHE_DIR})",
+    )
+    parser.add_argument(
+        "--single-call",
+        action="store_true",
+        help="Extract and map each invoice in one API call instead of two",
+    )
+    parser.add_argument(
+        "--concurrency",
+        "-c",
+        type=int,
+        default=MAX_CONCURRENCY,
+        help=f"Invoices processed in parallel (default: {MAX_CONCURRENCY})",
+    )
+    parser.add_argument(
+        "--invoices-per-call",
+        type=int,
+        default=1,
+        help="Map this many invoices per API call (10-20 saves tokens on large runs)",
+    )
+    parser.add_argument(
+        "--no-cache",
+        action="store_true",
+        help="Ignore and do not write the schema and extraction caches",
+    )
     
     args = parser.parse_args()
-    main(template_path=args.template, invoice_dir=args.invoices, auto_confirm=args.yes)
+    if args.concurrency < 1:
+        parser.error("--concurrency must be at least 1")
+    if args.invoices_per_call < 1:
+        parser.error("--invoices-per-call must be at least 1")
+    main(
+        template_path=args.template,
+        invoice_dir=args.invoices,
+        auto_confirm=args.yes,
+        use_batch=args.batch,
+        cache_dir=args.cache_dir,
+        single_call=args.single_call,
+        concurrency=args.concurrency,
+        invoices_per_call=args.invoices_per_call,
+        no_cache=args.no_cache,
+    )
@@ -1,31 +1,12 @@
 """
 Semantic mapper that maps extracted invoice data to CSV schema.
 """
-from typing import Dict, List, Any, Tuple
+from typing import Dict, List, Any, Tuple, Union
 from openai_client import OpenAIClient
+from utils import json_dumps
 
-
-class SemanticMapper:
-    """Map extracted invoice data to CSV schema using semantic matching."""
-    
-    def __init__(self, openai_client: OpenAIClient):
-        """Initialize mapper with OpenAI client."""
-        self.client = openai_client
-    
-    def map_invoice_to_schema(
-        self, invoice_data: Dict[str, Any], schema: List[Dict[str, Any]]
-    ) -> Tuple[Dict[str, Any], Dict[str, float], Dict[str, Any]]:
-        """
-        Map extracted invoice data to CSV schema columns.
-        
-        Args:
-            invoice_data: Extracted invoice data dictionary
-            schema: CSV schema with semantic information
-            
-        Returns:
-            Tuple of (mapped_data, confidence_scores, api_usage)
-        """
-        system_prompt = """You are a data mapping expert. Your task is to map extracted invoice data to CSV column headers based on semantic meaning, not exact string matching.
+# Mapping requests start with this, then the CSV schema; see SemanticMapper._system_prompt
+_SYSTEM_PROMPT = """You are a data mapping expert. Your task is to map extracted invoice data to CSV column headers based on semantic meaning, not exact string matching.
 
 You will receive:
 1. Extracted invoice data (JSON)
@@ -59,34 +40,111 @@ Confidence scores:
 - 0.6-0.7: Reasonable match with some inference
 - 0.4-0.5: Weak match, significant inference
 - 0.0-0.3: No match found, null value"""
+
+# Appended to the system prompt when several invoices share one request
+_MULTI_INVOICE_INSTRUCTIONS = """
+
+You will receive several invoices at once, each with a numeric "id". Map every invoice independently and return a JSON object with this structure instead:
+{
+  "results": [
+    {
+      "id": 1,
+      "mapped_data": {"column_header_1": "mapped_value or null"},
+      "confidence_scores": {"column_header_1": 0.95}
+    }
+  ]
+}
+
+Return exactly one entry per invoice id."""
+
+
+class SemanticMapper:
+    """Map extracted invoice data to CSV schema using semantic matching."""
+    
+    def __init__(self, openai_client: OpenAIClient):
+        """Initialize mapper with OpenAI client."""
+        self.client = openai_client
+        # System prompts by (id(schema), multi_invoice); the schema is kept
+        # alongside so its id cannot be reused while the entry exists
+        self._system_prompts: Dict[Tuple[int, bool], Tuple[List[Dict[str, Any]], str]] = {}
+    
+    def map_invoice_to_schema(
+        self, invoice_data: Dict[str, Any], schema: List[Dict[str, Any]]
+    ) -> Tuple[Dict[str, Any], Dict[str, float], Dict[str, Any]]:
+        """
+        Map extracted invoice data to CSV schema columns.
         
-        # Prepare schema description
-        schema_description = self._format_schema_description(schema)
+        Args:
+            invoice_data: Extracted invoice data dictionary
+            schema: CSV schema with semantic information
+            
+        Returns:
+            Tuple of (mapped_data, confidence_scores, api_usage)
+        """
+        response = self.client.chat_completion(
+            messages=self._build_messages(invoice_data, schema),
+            response_format={"type": "json_object"},
+            temperature=0.0,
+        )
         
-        user_prompt = f"""Map this extracted invoice data to the CSV schema:
-
-EXTRACTED INVOICE DATA:
+        mapped_data, normalized_scores = self._parse_mapping(response, schema)
+        return mapped_data, normalized_scores, response.get("usage", {})
+    
+    def _build_messages(
+        self, invoice_data: Dict[str, Any], schema: List[Dict[str, Any]]
+    ) -> List[Dict[str, str]]:
+        """Build the chat messages for mapping one invoice."""
+        user_prompt = f"""EXTRACTED INVOICE DATA:
 {self._format_invoice_data(invoice_data)}
 
-CSV SCHEMA:
-{schema_description}
-
 Perform semantic mapping and return the mapped data with confidence scores."""
         
-        messages = [
-            {"role": "system", "content": system_prompt},
+        return [
+            {"role": "system", "content": self._system_prompt(schema)},
             {"role": "user", "content": user_prompt},
         ]
+    
+    def _system_prompt(self, schema: List[Dict[str, Any]], multi_invoice: bool = False) -> str:
+        """
+        Build the system prompt: instructions followed by the CSV schema.
         
-        response = self.client.chat_completion(
-            messages=messages,
-            response_format={"type": "json_object"},
-            temperature=0.0,
-        )
+        Everything that is the same for every invoice of a run lives here, so
+        consecutive requests share a long byte-identical prefix that OpenAI's
+        automatic prompt caching can bill at the cached-input rate. Only the
+        invoice data in the user message varies. The prompt is built once
+        per schema and reused for every invoice.
+        """
+        key = (id(schema), multi_invoice)
+        cached = self._system_prompts.get(key)
+        if cached is not None and cached[0] is schema:
+            return cached[1]
         
-        result = self.client.parse_json_response(response)
-        api_usage = response.get("usage", {})
+        prompt = f"{_SYSTEM_PROMPT}\n\nCSV SCHEMA:\n{self._format_schema_description(schema)}"
+        if multi_invoice:
+            prompt += _MULTI_INVOICE_INSTRUCTIONS
+        self._system_prompts[key] = (schema, prompt)
+        return prompt
+    
+    def _parse_mapping(
+        self, response: Dict[str, Any], schema: List[Dict[str, Any]]
+    ) -> Tuple[Dict[str, Any], Dict[str, float]]:
+        """Parse and validate a mapping response into (mapped_data, confidence_scores)."""
+        return self.normalize_mapping(self.client.parse_json_response(response), schema)
+    
+    def normalize_mapping(
+        self, result: Dict[str, Any], schema: List[Dict[str, Any]]
+    ) -> Tuple[Dict[str, Any], Dict[str, float]]:
+        """
+        Validate a parsed mapping and fill it out to the full schema.
         
+        Args:
+            result: Parsed JSON holding mapped_data and confidence_scores
+            schema: CSV schema with semantic information
+            
+        Returns:
+            Tuple of (mapped_data, confidence_scores) with every schema column
+            present and every score clamped to 0.0-1.0
+        """
         # Validate response structure
         if "mapped_data" not in result:
             raise ValueError("Mapping response missing 'mapped_data'")
@@ -96,48 +154,170 @@ Perform semantic mapping and return the mapped data with confidence scores."""
         mapped_data = result["mapped_data"]
         confidence_scores = result["confidence_scores"]
         
-        # Ensure all schema columns are present
-        schema_headers = {col["header"] for col in schema}
-        mapped_headers = set(mapped_data.keys())
-        
         # Add missing columns with null values and 0.0 confidence
-        for header in schema_headers:
+        for col in schema:
+            header = col["header"]
             if header not in mapped_data:
                 mapped_data[header] = None
                 confidence_scores[header] = 0.0
         
-        # Normalize confidence scores to 0.0-1.0 range
+        # Clamp every score the model returned to the 0.0-1.0 range
         normalized_scores = {}
         for header, score in confidence_scores.items():
             try:
-                score_float = float(score)
-                normalized_scores[header] = max(0.0, min(1.0, score_float))
+                score = float(score)
             except (ValueError, TypeError):
-                normalized_scores[header] = 0.0
+                score = 0.0
+            normalized_scores[header] = 0.0 if score < 0.0 else score if score <= 1.0 else 1.0
         
-        return mapped_data, normalized_scores, api_usage
+        return mapped_data, normalized_scores
+    
+    def map_batch(
+        self, invoices: List[Dict[str, Any]], schema: List[Dict[str, Any]]
+    ) -> List[Union[Tuple[Dict[str, Any], Dict[str, float], Dict[str, Any]], Exception]]:
+        """
+        Map several extracted invoices in a single chat completion.
+        
+        The system prompt and schema are sent once for the whole group
+        instead of once per invoice. The call's token usage is reported on
+        the first successful result; the others carry zero usage marked
+        "shared_call".
+        
+        Args:
+            invoices: Extracted invoice data dictionaries
+            schema: CSV schema with semantic information
+            
+        Returns:
+            List aligned with invoices holding (mapped_data, confidence_scores,
+            api_usage) or the exception raised for that invoice
+        """
+        if len(invoices) == 1:
+            try:
+                return [self.map_invoice_to_schema(invoices[0], schema)]
+            except Exception as e:
+                return [e]
+        
+        numbered = "\n\n".join(
+            f"INVOICE id={invoice_id}:\n{self._format_invoice_data(invoice_data)}"
+            for invoice_id, invoice_data in enumerate(invoices, 1)
+        )
+        user_prompt = f"""{numbered}
+
+Perform semantic mapping and return one result per invoice id."""
+        
+        messages = [
+            {"role": "system", "content": self._system_prompt(schema, multi_invoice=True)},
+            {"role": "user", "content": user_prompt},
+        ]
+        
+        try:
+            response = self.client.chat_completion(
+                messages=messages,
+                response_format={"type": "json_object"},
+                temperature=0.0,
+            )
+            entries = self.client.parse_json_response(response).get("results")
+            if not isinstance(entries, list):
+                raise ValueError("Mapping response missing 'results'")
+        except Exception as e:
+            return [e] * len(invoices)
+        
+        by_id = {
+            entry.get("id"): entry for entry in entries if isinstance(entry, dict)
+        }
+        shared_usage = {
+            "prompt_tokens": 0, "completion_tokens": 0, "total_tokens": 0, "shared_call": True
+        }
+        
+        results = []
+        usage_reported = False
+        for invoice_id in range(1, len(invoices) + 1):
+            try:
+                entry = by_id.get(invoice_id) or by_id.get(str(invoice_id))
+                if entry is None:
+                    raise ValueError(f"Mapping response has no result for invoice id {invoice_id}")
+                mapped_data, normalized_scores = self.normalize_mapping(entry, schema)
+            except Exception as e:
+                results.append(e)
+                continue
+            
+            api_usage = dict(shared_usage) if usage_reported else response.get("usage", {})
+            usage_reported = True
+            results.append((mapped_data, normalized_scores, api_usage))
+        
+        return results
+    
+    def map_with_batch_api(
+        self,
+        invoices: List[Dict[str, Any]],
+        schema: List[Dict[str, Any]],
+    ) -> List[Union[Tuple[Dict[str, Any], Dict[str, float], Dict[str, Any]], Exception]]:
+        """
+        Map several extracted invoices through the OpenAI Batch API.
+        
+        Args:
+            invoices: Extracted invoice data dictionaries
+            schema: CSV schema with semantic information
+            
+        Returns:
+            List aligned with invoices holding (mapped_data, confidence_scores,
+            api_usage) or the exception raised for that invoice
+        """
+        if not invoices:
+            return []
+        
+        request_bodies = {
+            str(index): self.client.build_request_body(
+                messages=self._build_messages(invoice_data, schema),
+                response_format={"type": "json_object"},
+                temperature=0.0,
+            )
+            for index, invoice_data in enumerate(invoices)
+        }
+        
+        try:
+            responses = self.client.run_batch(request_bodies)
+        except Exception as e:
+            return [e] * len(invoices)
+        
+        results = []
+        for custom_id in request_bodies:
+            response = responses[custom_id]
+            try:
+                if isinstance(response, Exception):
+                    raise response
+                mapped_data, normalized_scores = self._parse_mapping(response, schema)
+                results.append((mapped_data, normalized_scores, response.get("usage", {})))
+            except Exception as e:
+                results.append(e)
+        
+        return results
     
     def _format_schema_description(self, schema: List[Dict[str, Any]]) -> str:
         """Format schema for prompt."""
-        lines = []
-        for col in schema:
-            header = col.get("header", "")
-            meaning = col.get("semantic_meaning", "")
-            data_type = col.get("data_type", "")
-            aliases = col.get("aliases", [])
-            
-            line = f"- {header}"
-            if meaning:
-                line += f" (meaning: {meaning})"
-            if data_type:
-                line += f" [type: {data_type}]"
-            if aliases:
-                line += f" [aliases: {', '.join(aliases)}]"
-            lines.append(line)
-        
-        return "\n".join(lines)
+        return format_schema_description(schema)
     
     def _format_invoice_data(self, invoice_data: Dict[str, Any]) -> str:
         """Format invoice data as readable string."""
-        import json
-        return json.dumps(invoice_data, indent=2)
+        return json_dumps(invoice_data, pretty=True).decode("utf-8")
+
+
+def format_schema_description(schema: List[Dict[str, Any]]) -> str:
+    """Describe each schema column on one line for use in prompts."""
+    lines = []
+    for col in schema:
+        header = col.get("header", "")
+        meaning = col.get("semantic_meaning", "")
+        data_type = col.get("data_type", "")
+        aliases = col.get("aliases", [])
+        
+        line = f"- {header}"
+        if meaning:
+            line += f" (meaning: {meaning})"
+        if data_type:
+            line += f" [type: {data_type}]"
+        if aliases:
+            line += f" [aliases: {', '.join(aliases)}]"
+        lines.append(line)
+    
+    return "\n".join(lines)
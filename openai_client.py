@@ -1,22 +1,128 @@
 """
 OpenAI API client wrapper for consistent API interactions.
 """
-import json
+import hashlib
+import importlib.util
+import random
+import threading
 import time
+from collections import OrderedDict
+from dataclasses import dataclass
+from functools import lru_cache
 from pathlib import Path
-from typing import Dict, List, Optional, Any, Union
-from openai import OpenAI
-from config import OPENAI_API_KEY, MAX_RETRIES, REQUEST_TIMEOUT
+from typing import Dict, Iterable, List, Optional, Any, Tuple, Union
+import httpx
+from openai import (
+    OpenAI,
+    AuthenticationError,
+    BadRequestError,
+    NotFoundError,
+    PermissionDeniedError,
+    RateLimitError,
+)
+from config import (
+    get_openai_api_key,
+    MAX_RETRIES,
+    REQUEST_TIMEOUT,
+    BATCH_COMPLETION_WINDOW,
+    BATCH_POLL_INTERVAL,
+    RESPONSE_CACHE_SIZE,
+    MAX_CONCURRENCY,
+    HTTP_MAX_CONNECTIONS,
+    HTTP_MAX_KEEPALIVE_CONNECTIONS,
+)
+from utils import encode_image_for_vision, json_dumps, json_loads
+
+# Client errors (4xx other than 429) that a retry would only repeat
+_NON_RETRYABLE_ERRORS = (
+    AuthenticationError,
+    BadRequestError,
+    NotFoundError,
+    PermissionDeniedError,
+)
+
+
+class NonJSONReplyError(ValueError):
+    """A streamed reply that was abandoned because it did not start as JSON."""
+    
+    def __init__(self, content: str):
+        super().__init__(f"Expected a JSON object, got: {content[:50]!r}")
+        self.content = content
+
+
+@dataclass(frozen=True)
+class ChatSettings:
+    """Validated model settings for chat completion requests."""
+    
+    model: str
+    temperature: float
+    max_tokens: Optional[int]
+    
+    def __post_init__(self):
+        if not self.model:
+            raise ValueError("Model name must not be empty")
+        if not 0.0 <= self.temperature <= 2.0:
+            raise ValueError(f"temperature must be between 0 and 2, got {self.temperature}")
+        if self.max_tokens is not None and self.max_tokens < 1:
+            raise ValueError(f"max_tokens must be positive, got {self.max_tokens}")
+    
+    @property
+    def options(self) -> Tuple[Tuple[str, Any], ...]:
+        """Request body fields for these settings (max_tokens only when set)."""
+        options = (("model", self.model), ("temperature", self.temperature))
+        if self.max_tokens is not None:
+            options += (("max_tokens", self.max_tokens),)
+        return options
+
+
+@lru_cache(maxsize=64)
+def _chat_options(
+    model: str, temperature: float, max_tokens: Optional[int]
+) -> Tuple[Tuple[str, Any], ...]:
+    """Validate settings once per combination and return their request fields."""
+    return ChatSettings(model, temperature, max_tokens).options
 
 
 class OpenAIClient:
     """Wrapper for OpenAI API calls with error handling and retries."""
     
-    def __init__(self):
-        """Initialize OpenAI client."""
-        if not OPENAI_API_KEY:
-            raise ValueError("OPENAI_API_KEY is required")
-        self.client = OpenAI(api_key=OPENAI_API_KEY)
+    def __init__(self, max_in_flight: int = MAX_CONCURRENCY):
+        """
+        Initialize OpenAI client.
+        
+        Args:
+            max_in_flight: Maximum number of API requests open at once across
+                all threads sharing this client (extraction and mapping pools)
+        """
+        api_key = get_openai_api_key()
+        
+        # One pooled HTTP client so worker threads reuse TLS connections;
+        # HTTP/2 multiplexing only when the optional h2 package is installed
+        self._http = httpx.Client(
+            http2=importlib.util.find_spec("h2") is not None,
+            limits=httpx.Limits(
+                max_keepalive_connections=HTTP_MAX_KEEPALIVE_CONNECTIONS,
+                max_connections=HTTP_MAX_CONNECTIONS,
+            ),
+            timeout=REQUEST_TIMEOUT,
+        )
+        self.client = OpenAI(api_key=api_key, http_client=self._http)
+        # chat_completion owns the retry policy; batch endpoints keep the SDK's retries
+        self._completions = self.client.with_options(max_retries=0).chat.completions
+        self._in_flight = threading.BoundedSemaphore(max_in_flight)
+        # Deterministic (temperature 0) responses by request hash, for this process only
+        self._response_cache: "OrderedDict[str, Dict[str, Any]]" = OrderedDict()
+        self._response_cache_lock = threading.Lock()
+    
+    def close(self) -> None:
+        """Close pooled HTTP connections."""
+        self._http.close()
+    
+    def __enter__(self) -> "OpenAIClient":
+        return self
+    
+    def __exit__(self, *exc_info) -> None:
+        self.close()
     
     def chat_completion(
         self,
@@ -24,6 +130,8 @@ class OpenAIClient:
         model: str = "gpt-4o",
         response_format: Optional[Dict[str, str]] = None,
         temperature: float = 0.0,
+        max_tokens: Optional[int] = None,
+        stream: bool = False,
     ) -> Dict[str, Any]:
         """
         Make a chat completion request with retries.
@@ -33,36 +141,161 @@ class OpenAIClient:
             model: Model name to use
             response_format: Optional response format (e.g., {"type": "json_object"})
             temperature: Sampling temperature
+            max_tokens: Optional cap on completion tokens
+            stream: Stream the completion; the timeout then applies between
+                chunks rather than to the whole response, and a reply that
+                is not JSON when JSON was requested fails on its first token
+                with NonJSONReplyError, which is not retried
             
         Returns:
-            Response dictionary from OpenAI API
+            Response dictionary from OpenAI API. A repeat of an identical
+            temperature-0 request is answered from memory with zero usage
+            and "cached": True
         """
+        body = self.build_request_body(messages, model, response_format, temperature, max_tokens)
+        
+        cache_key = None
+        if temperature == 0.0 and RESPONSE_CACHE_SIZE > 0:
+            cache_key = self._response_cache_key(body)
+            cached = self._response_cache_get(cache_key)
+            if cached is not None:
+                return cached
+        
+        kwargs = dict(body, timeout=REQUEST_TIMEOUT)
         for attempt in range(MAX_RETRIES):
             try:
-                kwargs = {
-                    "model": model,
-                    "messages": messages,
-                    "temperature": temperature,
-                    "timeout": REQUEST_TIMEOUT,
-                }
+                # Held only while the request is open, not during retry backoff
+                with self._in_flight:
+                    if stream:
+                        result = self._stream_completion(kwargs)
+                    else:
+                        response = self._completions.create(**kwargs)
+                        result = {
+                            "content": response.choices[0].message.content,
+                            "model": response.model,
+                            "usage": {
+                                "prompt_tokens": response.usage.prompt_tokens,
+                                "completion_tokens": response.usage.completion_tokens,
+                                "total_tokens": response.usage.total_tokens,
+                            },
+                        }
                 
-                if response_format:
-                    kwargs["response_format"] = response_format
-                
-                response = self.client.chat.completions.create(**kwargs)
-                return {
-                    "content": response.choices[0].message.content,
-                    "model": response.model,
-                    "usage": {
-                        "prompt_tokens": response.usage.prompt_tokens,
-                        "completion_tokens": response.usage.completion_tokens,
-                        "total_tokens": response.usage.total_tokens,
-                    },
-                }
+                if cache_key is not None:
+                    self._response_cache_put(cache_key, result)
+                return result
+            except _NON_RETRYABLE_ERRORS as e:
+                # Resending the same request cannot succeed
+                raise RuntimeError(f"OpenAI API call rejected: {str(e)}") from e
+            except NonJSONReplyError:
+                # An identical temperature-0 resend would answer the same way;
+                # let the caller re-ask with the bad reply in the conversation
+                raise
             except Exception as e:
                 if attempt == MAX_RETRIES - 1:
                     raise RuntimeError(f"OpenAI API call failed after {MAX_RETRIES} attempts: {str(e)}")
-                time.sleep(2 ** attempt)  # Exponential backoff
+                time.sleep(self._retry_delay(e, attempt))
+    
+    @staticmethod
+    def _retry_delay(error: Exception, attempt: int) -> float:
+        """
+        Seconds to wait before retrying a failed request.
+        
+        Full-jitter exponential backoff, so concurrent workers that failed
+        together do not retry in lockstep. A rate-limit error waits at least
+        as long as the server's Retry-After header asks.
+        
+        Args:
+            error: Exception raised by the failed attempt
+            attempt: Zero-based index of the failed attempt
+            
+        Returns:
+            Delay in seconds
+        """
+        backoff = 2 ** attempt
+        if isinstance(error, RateLimitError):
+            try:
+                backoff = float(error.response.headers.get("retry-after", backoff))
+            except (TypeError, ValueError):
+                pass  # HTTP-date form or missing response; keep exponential backoff
+            return backoff + random.random()
+        return random.uniform(0, backoff)
+    
+    @staticmethod
+    def _response_cache_key(body: Dict[str, Any]) -> str:
+        """Hash a request body deterministically."""
+        return hashlib.sha256(json_dumps(body, sort_keys=True)).hexdigest()
+    
+    def _response_cache_get(self, cache_key: str) -> Optional[Dict[str, Any]]:
+        """Return a cached response (with zero usage), or None."""
+        with self._response_cache_lock:
+            result = self._response_cache.get(cache_key)
+            if result is None:
+                return None
+            self._response_cache.move_to_end(cache_key)
+        
+        # No tokens are spent on a cache hit
+        usage = {"prompt_tokens": 0, "completion_tokens": 0, "total_tokens": 0, "cached": True}
+        return {**result, "usage": usage}
+    
+    def _response_cache_put(self, cache_key: str, result: Dict[str, Any]) -> None:
+        """Store a response, evicting the least recently used one."""
+        with self._response_cache_lock:
+            self._response_cache[cache_key] = result
+            self._response_cache.move_to_end(cache_key)
+            if len(self._response_cache) > RESPONSE_CACHE_SIZE:
+                self._response_cache.popitem(last=False)
+    
+    def _stream_completion(self, kwargs: Dict[str, Any]) -> Dict[str, Any]:
+        """
+        Run a streaming chat completion and collect it into a response dictionary.
+        
+        Args:
+            kwargs: Request arguments from build_request_body plus timeout
+            
+        Returns:
+            Response dictionary in the same shape as chat_completion
+        """
+        expect_json = (kwargs.get("response_format") or {}).get("type") in (
+            "json_object", "json_schema"
+        )
+        model = kwargs["model"]
+        usage = None
+        parts: List[str] = []
+        started = False
+        
+        stream = self._completions.create(
+            stream=True, stream_options={"include_usage": True}, **kwargs
+        )
+        try:
+            for chunk in stream:
+                model = chunk.model or model
+                if chunk.usage is not None:
+                    usage = chunk.usage
+                if not chunk.choices:
+                    continue
+                
+                delta = chunk.choices[0].delta.content
+                if not delta:
+                    continue
+                
+                if expect_json and not started and delta.strip():
+                    # Bail out early instead of paying for a full non-JSON reply
+                    if not delta.lstrip().startswith("{"):
+                        raise NonJSONReplyError("".join(parts) + delta)
+                    started = True
+                parts.append(delta)
+        finally:
+            stream.close()
+        
+        return {
+            "content": "".join(parts),
+            "model": model,
+            "usage": {
+                "prompt_tokens": usage.prompt_tokens if usage else 0,
+                "completion_tokens": usage.completion_tokens if usage else 0,
+                "total_tokens": usage.total_tokens if usage else 0,
+            },
+        }
     
     def vision_completion(
         self,
@@ -70,6 +303,7 @@ class OpenAIClient:
         prompt: str,
         model: str = "gpt-4o",
         max_tokens: int = 4096,
+        response_format: Optional[Dict[str, str]] = None,
     ) -> Dict[str, Any]:
         """
         Make a vision API call for image analysis.
@@ -79,41 +313,186 @@ class OpenAIClient:
             prompt: Text prompt for the vision model
             model: Model name to use
             max_tokens: Maximum tokens in response
+            response_format: Response format (defaults to {"type": "json_object"})
             
         Returns:
             Response dictionary from OpenAI API
         """
-        import base64
-        
-        # Read and encode image
+        mime_type = "image/jpeg"
         if isinstance(image_path, Path):
-            with open(image_path, "rb") as image_file:
-                base64_image = base64.b64encode(image_file.read()).decode("utf-8")
-        else:
-            base64_image = image_path
-        
-        messages = [
-            {
-                "role": "user",
-                "content": [
-                    {"type": "text", "text": prompt},
-                    {
-                        "type": "image_url",
-                        "image_url": {
-                            "url": f"data:image/jpeg;base64,{base64_image}"
-                        },
-                    },
-                ],
-            }
-        ]
+            image_path, mime_type = encode_image_for_vision(image_path)
         
         return self.chat_completion(
-            messages=messages,
+            messages=self.build_vision_messages(prompt, image_path, mime_type),
             model=model,
-            response_format={"type": "json_object"},
+            response_format=response_format or {"type": "json_object"},
             temperature=0.0,
+            max_tokens=max_tokens,
         )
     
+    @staticmethod
+    def build_request_body(
+        messages: List[Dict[str, Any]],
+        model: str = "gpt-4o",
+        response_format: Optional[Dict[str, str]] = None,
+        temperature: float = 0.0,
+        max_tokens: Optional[int] = None,
+    ) -> Dict[str, Any]:
+        """
+        Build the chat completion request body shared by direct and batch calls.
+        
+        Args:
+            messages: List of message dictionaries
+            model: Model name to use
+            response_format: Optional response format
+            temperature: Sampling temperature
+            max_tokens: Optional cap on completion tokens
+            
+        Returns:
+            Request body dictionary
+            
+        Raises:
+            ValueError: If the model settings are invalid (checked once per
+                distinct combination)
+        """
+        body = dict(_chat_options(model, temperature, max_tokens))
+        body["messages"] = messages
+        if response_format:
+            body["response_format"] = response_format
+        return body
+    
+    @staticmethod
+    def build_vision_messages(
+        prompt: str,
+        base64_images: Union[str, List[str]],
+        mime_type: str = "image/jpeg",
+        detail: Optional[str] = None,
+    ) -> List[Dict[str, Any]]:
+        """
+        Build a single user message carrying a text prompt and one or more images.
+        
+        Args:
+            prompt: Text prompt for the vision model
+            base64_images: Base64 encoded image, or a list of them in page order
+            mime_type: MIME type of the encoded images
+            detail: Optional image detail level ("low", "high" or "auto")
+            
+        Returns:
+            List of message dictionaries
+        """
+        if isinstance(base64_images, str):
+            base64_images = [base64_images]
+        
+        content: List[Dict[str, Any]] = [{"type": "text", "text": prompt}]
+        for base64_image in base64_images:
+            image_url = {"url": f"data:{mime_type};base64,{base64_image}"}
+            if detail:
+                image_url["detail"] = detail
+            content.append({"type": "image_url", "image_url": image_url})
+        return [{"role": "user", "content": content}]
+    
+    def run_batch(
+        self, request_bodies: Dict[str, Dict[str, Any]]
+    ) -> Dict[str, Union[Dict[str, Any], Exception]]:
+        """
+        Run chat completions through the OpenAI Batch API and wait for the results.
+        
+        Batch requests are billed at a discount but may take up to the
+        completion window to finish, so this is only for non-interactive runs.
+        
+        Args:
+            request_bodies: Mapping of custom_id -> body from build_request_body
+            
+        Returns:
+            Mapping of custom_id -> response dictionary (same shape as
+            chat_completion) or the exception describing why that request failed
+        """
+        batch_id = self.submit_batch(request_bodies)
+        return self.wait_for_batch(batch_id, request_bodies.keys())
+    
+    def submit_batch(self, request_bodies: Dict[str, Dict[str, Any]]) -> str:
+        """
+        Upload chat completion requests as a JSONL file and start a batch.
+        
+        Args:
+            request_bodies: Mapping of custom_id -> body from build_request_body
+            
+        Returns:
+            ID of the created batch
+        """
+        lines = [
+            json_dumps({
+                "custom_id": custom_id,
+                "method": "POST",
+                "url": "/v1/chat/completions",
+                "body": body,
+            })
+            for custom_id, body in request_bodies.items()
+        ]
+        input_file = self.client.files.create(
+            file=("batch_input.jsonl", b"\n".join(lines)),
+            purpose="batch",
+        )
+        batch = self.client.batches.create(
+            input_file_id=input_file.id,
+            endpoint="/v1/chat/completions",
+            completion_window=BATCH_COMPLETION_WINDOW,
+        )
+        return batch.id
+    
+    def wait_for_batch(
+        self, batch_id: str, custom_ids: Iterable[str] = ()
+    ) -> Dict[str, Union[Dict[str, Any], Exception]]:
+        """
+        Poll a batch until it finishes and collect its per-request results.
+        
+        Args:
+            batch_id: ID returned by submit_batch
+            custom_ids: IDs that were submitted; any without an output line
+                are reported as failed
+            
+        Returns:
+            Mapping of custom_id -> response dictionary (same shape as
+            chat_completion) or the exception describing why that request failed
+        """
+        batch = self.client.batches.retrieve(batch_id)
+        while batch.status not in ("completed", "failed", "expired", "cancelled"):
+            time.sleep(BATCH_POLL_INTERVAL)
+            batch = self.client.batches.retrieve(batch_id)
+        
+        if batch.status != "completed":
+            raise RuntimeError(f"OpenAI batch {batch_id} ended with status '{batch.status}'")
+        
+        results: Dict[str, Union[Dict[str, Any], Exception]] = {}
+        for file_id in (batch.output_file_id, batch.error_file_id):
+            if not file_id:
+                continue
+            for line in self.client.files.content(file_id).text.splitlines():
+                if not line.strip():
+                    continue
+                item = json_loads(line)
+                response = item.get("response") or {}
+                if response.get("status_code") == 200:
+                    body = response["body"]
+                    results[item["custom_id"]] = {
+                        "content": body["choices"][0]["message"]["content"],
+                        "model": body["model"],
+                        "usage": {
+                            "prompt_tokens": body["usage"]["prompt_tokens"],
+                            "completion_tokens": body["usage"]["completion_tokens"],
+                            "total_tokens": body["usage"]["total_tokens"],
+                        },
+                    }
+                else:
+                    error = item.get("error") or response.get("body", {}).get("error")
+                    results[item["custom_id"]] = RuntimeError(f"Batch request failed: {error}")
+        
+        # Requests that produced no output line at all
+        for custom_id in custom_ids:
+            results.setdefault(custom_id, RuntimeError("Batch request returned no result"))
+        
+        return results
+    
     def parse_json_response(self, response: Dict[str, Any]) -> Dict[str, Any]:
         """
         Parse JSON response from OpenAI API.
@@ -126,6 +505,6 @@ class OpenAIClient:
         """
         content = response.get("content", "")
         try:
-            return json.loads(content)
-        except json.JSONDecodeError as e:
+            return json_loads(content)
+        except ValueError as e:
             raise ValueError(f"Failed to parse JSON response: {str(e)}\nContent: {content}")
@@ -1,19 +1,40 @@
 """
 CSV schema parser that uses OpenAI to understand semantic meaning of columns.
 """
-import pandas as pd
+import csv
+import hashlib
+from functools import lru_cache
 from pathlib import Path
-from typing import Dict, List, Any, Tuple
+from typing import Dict, List, Any, Optional, Tuple
+from config import SCHEMA_MODEL, KNOWN_TEMPLATES_PATH
 from openai_client import OpenAIClient
-from utils import validate_csv_template
+from utils import SchemaCache, json_dumps, json_loads, validate_csv_template
+
+# Bump whenever the schema inference prompt changes so cached schemas are invalidated
+SCHEMA_PROMPT_VERSION = "v1"
 
 
 class SchemaParser:
     """Parse CSV template and infer semantic schema using OpenAI."""
     
-    def __init__(self, openai_client: OpenAIClient):
-        """Initialize schema parser with OpenAI client."""
+    def __init__(
+        self,
+        openai_client: OpenAIClient,
+        cache: Optional[SchemaCache] = None,
+        known_templates_path: Optional[Path] = KNOWN_TEMPLATES_PATH,
+    ):
+        """
+        Initialize schema parser with OpenAI client.
+        
+        Args:
+            openai_client: OpenAI client wrapper
+            cache: Optional persistent cache of inferred schemas
+            known_templates_path: JSON registry of precomputed schemas for
+                common templates (None disables it)
+        """
         self.client = openai_client
+        self.cache = cache
+        self.known_templates_path = known_templates_path
     
     def parse_template(self, csv_path: Path) -> Tuple[Dict[str, Any], Dict[str, Any]]:
         """
@@ -27,18 +48,17 @@ class SchemaParser:
         """
         validate_csv_template(csv_path)
         
-        # Read CSV headers
-        try:
-            df = pd.read_csv(csv_path, nrows=0)  # Read only headers
-            headers = df.columns.tolist()
-        except Exception as e:
-            raise ValueError(f"Failed to read CSV template: {str(e)}")
+        headers = self._read_headers(csv_path)
         
-        if not headers:
-            raise ValueError("CSV template has no headers")
-        
-        # Generate schema using OpenAI
-        schema, api_usage = self._infer_schema(headers)
+        # Generate schema using OpenAI, unless the template is a known one or
+        # this header set was seen before
+        schema, api_usage = self._known_schema(headers)
+        if schema is None:
+            schema, api_usage = self._cached_schema(headers)
+        if schema is None:
+            schema, api_usage = self._infer_schema(headers)
+            if self.cache is not None:
+                self.cache.set(self._cache_key(headers), json_dumps(schema).decode("utf-8"))
         
         schema_info = {
             "headers": headers,
@@ -48,6 +68,95 @@ class SchemaParser:
         
         return schema_info, api_usage
     
+    @staticmethod
+    def _read_headers(csv_path: Path) -> List[str]:
+        """
+        Read the header row of a CSV template.
+        
+        Only the first line is parsed, with the stdlib csv module rather than
+        pandas. Headers are named the way pandas.read_csv names them: a blank
+        header becomes "Unnamed: <index>" and repeats get ".1", ".2", ...
+        suffixes, so existing schema cache keys stay valid.
+        
+        Args:
+            csv_path: Path to CSV template file
+            
+        Returns:
+            List of column headers
+        """
+        try:
+            # utf-8-sig drops the byte order mark Excel writes
+            with open(csv_path, newline="", encoding="utf-8-sig") as f:
+                row = next(csv.reader(f), [])
+        except (OSError, UnicodeDecodeError, csv.Error) as e:
+            raise ValueError(f"Failed to read CSV template: {str(e)}")
+        
+        if not any(cell.strip() for cell in row):
+            raise ValueError("CSV template has no headers")
+        
+        headers = []
+        seen = set(row)
+        counts: Dict[str, int] = {}
+        for index, header in enumerate(row):
+            if not header.strip():
+                header = f"Unnamed: {index}"
+            if header in counts:
+                # Skip suffixes already taken by a real column
+                while True:
+                    counts[header] += 1
+                    candidate = f"{header}.{counts[header]}"
+                    if candidate not in seen:
+                        break
+                seen.add(candidate)
+                header = candidate
+            else:
+                counts[header] = 0
+            headers.append(header)
+        
+        return headers
+    
+    def _known_schema(
+        self, headers: List[str]
+    ) -> Tuple[Optional[List[Dict[str, Any]]], Dict[str, Any]]:
+        """Return (schema, api_usage) from the known-template registry, or (None, {})."""
+        if self.known_templates_path is None:
+            return None, {}
+        
+        template = load_known_templates(self.known_templates_path).get(_header_set_key(headers))
+        if template is None:
+            return None, {}
+        
+        # No API call is made for a known template
+        api_usage = {
+            "prompt_tokens": 0,
+            "completion_tokens": 0,
+            "total_tokens": 0,
+            "cached": True,
+            "known_template": template["name"],
+        }
+        return template["columns"], api_usage
+    
+    def _cached_schema(
+        self, headers: List[str]
+    ) -> Tuple[Optional[List[Dict[str, Any]]], Dict[str, Any]]:
+        """Return (schema, api_usage) from the cache, or (None, {}) on a miss."""
+        if self.cache is None:
+            return None, {}
+        
+        schema_json = self.cache.get(self._cache_key(headers))
+        if schema_json is None:
+            return None, {}
+        
+        # No tokens are spent on a cache hit
+        api_usage = {"prompt_tokens": 0, "completion_tokens": 0, "total_tokens": 0, "cached": True}
+        return json_loads(schema_json), api_usage
+    
+    @staticmethod
+    def _cache_key(headers: List[str]) -> str:
+        """Hash the header set together with the prompt version and model."""
+        parts = [SCHEMA_PROMPT_VERSION, SCHEMA_MODEL] + sorted(headers)
+        return hashlib.sha256("\0".join(parts).encode("utf-8")).hexdigest()
+    
     def _infer_schema(self, headers: List[str]) -> Tuple[List[Dict[str, Any]], Dict[str, Any]]:
         """
         Use OpenAI to infer semantic meaning and data types for each column.
@@ -92,6 +201,7 @@ Return the JSON schema analysis as specified."""
         
         response = self.client.chat_completion(
             messages=messages,
+            model=SCHEMA_MODEL,
             response_format={"type": "json_object"},
             temperature=0.0,
         )
@@ -114,3 +224,40 @@ Return the JSON schema analysis as specified."""
             raise ValueError(f"Schema missing headers: {missing}")
         
         return schema, api_usage
+
+
+def _header_set_key(headers: List[str]) -> str:
+    """Hash a header set independently of column order."""
+    return hashlib.sha256("\0".join(sorted(headers)).encode("utf-8")).hexdigest()
+
+
+@lru_cache(maxsize=None)
+def load_known_templates(path: Path) -> Dict[str, Dict[str, Any]]:
+    """
+    Load the known-template registry, indexed by header set.
+    
+    Each entry in the file's "templates" list holds a name, the template's
+    headers and its schema "columns" in the shape _infer_schema returns.
+    Entries whose columns do not cover exactly their headers are skipped.
+    
+    Args:
+        path: Registry JSON file; a missing file means an empty registry
+        
+    Returns:
+        Mapping of header-set hash -> template entry
+    """
+    try:
+        registry = json_loads(path.read_bytes())
+    except FileNotFoundError:
+        return {}
+    except (OSError, ValueError) as e:
+        raise ValueError(f"Failed to read known templates {path}: {str(e)}")
+    
+    templates = {}
+    for template in registry.get("templates", []):
+        headers = template.get("headers", [])
+        columns = template.get("columns", [])
+        if {col.get("header") for col in columns} != set(headers):
+            continue
+        templates[_header_set_key(headers)] = template
+    return templates
@@ -2,20 +2,172 @@
 Utility functions for file handling and validation.
 """
 import base64
+import io
+import json
+import mmap
+import os
+import re
+import sqlite3
+import threading
+import time
+from contextlib import closing
+from functools import lru_cache
 from pathlib import Path
-from typing import List, Optional
+from typing import Any, List, Optional, Tuple, Union
 from config import (
     SUPPORTED_IMAGE_EXTENSIONS,
     SUPPORTED_PDF_EXTENSIONS,
     SUPPORTED_TEXT_EXTENSIONS,
     SUPPORTED_EXTENSIONS,
+    IMAGE_MIME_TYPES,
+    ENCODED_IMAGE_CACHE_SIZE,
+    IMAGE_DOWNSCALE_MIN_BYTES,
+    IMAGE_MAX_SIDE,
+    IMAGE_JPEG_QUALITY,
+    MIN_INVOICE_TEXT_LENGTH,
 )
 
+try:
+    import orjson  # Optional: Rust-backed JSON, several times faster than the stdlib module
+except ImportError:
+    orjson = None
+
+try:
+    from PIL import Image, ImageOps  # Optional: only used to shrink large photos
+except ImportError:
+    Image = None
+
+try:
+    import pypdfium2 as pdfium  # Optional: native text extraction, much faster than pypdf
+except ImportError:
+    pdfium = None
+
+# PDFium is not thread-safe, even across separate documents
+_PDFIUM_LOCK = threading.Lock()
+
+_INVOICE_KEYWORDS = re.compile(r"invoice|total|amount|subtotal|tax|gst|bill", re.IGNORECASE)
+
+
+def json_loads(data: Union[str, bytes]) -> Any:
+    """
+    Parse JSON text, using orjson when installed.
+    
+    Raises:
+        json.JSONDecodeError (a ValueError) on invalid input, from either parser
+    """
+    if orjson is not None:
+        return orjson.loads(data)  # orjson.JSONDecodeError subclasses json.JSONDecodeError
+    return json.loads(data)
+
+
+def json_dumps(data: Any, pretty: bool = False, sort_keys: bool = False) -> bytes:
+    """
+    Encode data as UTF-8 JSON, using orjson when installed.
+    
+    Both encoders produce the same bytes: non-ASCII characters as-is, no
+    spaces when compact and two-space indentation when pretty.
+    
+    Args:
+        data: JSON-serializable value (non-string dict keys are converted)
+        pretty: Indent the output
+        sort_keys: Sort dictionary keys
+        
+    Returns:
+        Encoded JSON
+    """
+    if orjson is not None:
+        option = orjson.OPT_NON_STR_KEYS
+        if pretty:
+            option |= orjson.OPT_INDENT_2
+        if sort_keys:
+            option |= orjson.OPT_SORT_KEYS
+        try:
+            return orjson.dumps(data, option=option)
+        except TypeError:
+            pass  # e.g. integers beyond 64 bits; the stdlib encoder handles them
+    
+    return json.dumps(
+        data,
+        indent=2 if pretty else None,
+        separators=(",", ": ") if pretty else (",", ":"),
+        sort_keys=sort_keys,
+        ensure_ascii=False,
+    ).encode("utf-8")
+
 
 def encode_image(image_path: Path) -> str:
-    """Encode image file to base64 string."""
+    """Encode image file to base64 string, reusing the result while the file is unchanged."""
+    stat = image_path.stat()
+    return _encode_image_cached(str(image_path), stat.st_mtime_ns, stat.st_size)
+
+
+@lru_cache(maxsize=ENCODED_IMAGE_CACHE_SIZE)
+def _encode_image_cached(image_path: str, mtime_ns: int, size: int) -> str:
+    """Encode image file to base64; mtime and size only key the cache."""
     with open(image_path, "rb") as image_file:
-        return base64.b64encode(image_file.read()).decode("utf-8")
+        if size == 0:
+            return ""  # mmap cannot map an empty file
+        # Encode straight from the page cache instead of copying the file into a bytes object
+        with mmap.mmap(image_file.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+            return base64.b64encode(mm).decode("ascii")
+
+
+def encode_image_for_vision(image_path: Path) -> Tuple[str, str]:
+    """
+    Encode an image invoice for the Vision API.
+    
+    Files over IMAGE_DOWNSCALE_MIN_BYTES (typically phone photos) are
+    downscaled to IMAGE_MAX_SIDE and re-encoded as JPEG when Pillow is
+    installed; anything else is sent as-is.
+    
+    Args:
+        image_path: Path to image file
+        
+    Returns:
+        Tuple of (base64_image, mime_type)
+    """
+    stat = image_path.stat()
+    if Image is not None and stat.st_size > IMAGE_DOWNSCALE_MIN_BYTES:
+        downscaled = _downscale_image_cached(str(image_path), stat.st_mtime_ns, stat.st_size)
+        if downscaled is not None:
+            return downscaled, "image/jpeg"
+    
+    return (
+        _encode_image_cached(str(image_path), stat.st_mtime_ns, stat.st_size),
+        get_image_mime_type(image_path),
+    )
+
+
+@lru_cache(maxsize=ENCODED_IMAGE_CACHE_SIZE)
+def _downscale_image_cached(image_path: str, mtime_ns: int, size: int) -> Optional[str]:
+    """
+    Downscale and JPEG-encode an image to base64; mtime and size only key the cache.
+    
+    Returns:
+        Base64 JPEG, or None if the image cannot be decoded or re-encoding
+        would not make it smaller
+    """
+    try:
+        with Image.open(image_path) as img:
+            # Phone photos are often stored sideways with an EXIF rotation tag
+            img = ImageOps.exif_transpose(img)
+            if img.mode not in ("RGB", "L"):
+                img = img.convert("RGB")  # JPEG has no alpha channel
+            img.thumbnail((IMAGE_MAX_SIDE, IMAGE_MAX_SIDE), Image.Resampling.LANCZOS)
+            
+            buffer = io.BytesIO()
+            img.save(buffer, "JPEG", quality=IMAGE_JPEG_QUALITY, optimize=True)
+    except (OSError, ValueError):
+        return None  # Let the Vision API see the original file
+    
+    if buffer.tell() >= size:
+        return None
+    return base64.b64encode(buffer.getbuffer()).decode("ascii")
+
+
+def get_image_mime_type(image_path: Path) -> str:
+    """Return the MIME type for an image file, used in base64 data URLs."""
+    return IMAGE_MIME_TYPES.get(image_path.suffix.lower(), "image/jpeg")
 
 
 def read_text_file(file_path: Path) -> str:
@@ -25,19 +177,60 @@ def read_text_file(file_path: Path) -> str:
 
 
 def read_pdf_file(file_path: Path) -> str:
-    """Read PDF file and extract text content."""
+    """
+    Read PDF file and extract text content.
+    
+    Uses pypdfium2 (native PDFium, several times faster) when installed and
+    falls back to pypdf otherwise.
+    """
     try:
+        if pdfium is not None:
+            with _PDFIUM_LOCK:
+                pdf = pdfium.PdfDocument(str(file_path))
+                try:
+                    return "\n".join(_pdfium_page_text(pdf, i) for i in range(len(pdf)))
+                finally:
+                    pdf.close()
+        
         from pypdf import PdfReader
         
         reader = PdfReader(file_path)
-        text_content = []
-        for page in reader.pages:
-            text_content.append(page.extract_text())
-        return "\n".join(text_content)
+        return "\n".join(page.extract_text() for page in reader.pages)
     except Exception as e:
         raise ValueError(f"Failed to read PDF file {file_path}: {str(e)}")
 
 
+def _pdfium_page_text(pdf: "pdfium.PdfDocument", index: int) -> str:
+    """Extract one page's text with PDFium, releasing the page handles afterwards."""
+    page = pdf[index]
+    try:
+        textpage = page.get_textpage()
+        try:
+            return textpage.get_text_range()
+        finally:
+            textpage.close()
+    finally:
+        page.close()
+
+
+def looks_like_invoice_text(text: str) -> bool:
+    """
+    Check whether extracted PDF text is usable for text-mode extraction.
+    
+    Any substantial text layer qualifies; a short one is enough as long as
+    it carries figures and an invoice keyword, since the text model is far
+    cheaper than a Vision call.
+    """
+    stripped = text.strip()
+    if len(stripped) > 50:
+        return True
+    return (
+        len(stripped) > MIN_INVOICE_TEXT_LENGTH
+        and any(ch.isdigit() for ch in stripped)
+        and _INVOICE_KEYWORDS.search(stripped) is not None
+    )
+
+
 def get_file_type(file_path: Path) -> str:
     """Determine file type based on extension."""
     ext = file_path.suffix.lower()
@@ -59,10 +252,15 @@ def find_invoice_files(directory: Path) -> List[Path]:
     if not directory.is_dir():
         raise ValueError(f"Path is not a directory: {directory}")
     
-    invoice_files = []
-    for file_path in directory.iterdir():
-        if file_path.is_file() and file_path.suffix in SUPPORTED_EXTENSIONS:
-            invoice_files.append(file_path)
+    # scandir entries carry their file type, so is_file() needs no extra stat
+    # (symlinks are still followed, as Path.is_file() did)
+    with os.scandir(directory) as entries:
+        invoice_files = [
+            Path(entry.path)
+            for entry in entries
+            if os.path.splitext(entry.name)[1].lower() in SUPPORTED_EXTENSIONS
+            and entry.is_file()
+        ]
     
     if not invoice_files:
         raise ValueError(f"No supported invoice files found in {directory}")
@@ -91,3 +289,42 @@ def format_file_size(size_bytes: int) -> str:
             return f"{size_bytes:.2f} {unit}"
         size_bytes /= 1024.0
     return f"{size_bytes:.2f} TB"
+
+
+class SchemaCache:
+    """Persistent SQLite store of inferred template schemas, keyed by header hash."""
+    
+    def __init__(self, db_path: Path):
+        """
+        Initialize the cache, creating the database on first use.
+        
+        Args:
+            db_path: Path to the SQLite database file
+        """
+        self.db_path = db_path
+        self.db_path.parent.mkdir(parents=True, exist_ok=True)
+        with closing(self._connect()) as conn, conn:
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS schemas "
+                "(key TEXT PRIMARY KEY, schema_json TEXT NOT NULL, created REAL NOT NULL)"
+            )
+    
+    def get(self, key: str) -> Optional[str]:
+        """Return the cached schema JSON for key, or None on a miss."""
+        with closing(self._connect()) as conn, conn:
+            row = conn.execute(
+                "SELECT schema_json FROM schemas WHERE key = ?", (key,)
+            ).fetchone()
+        return row[0] if row else None
+    
+    def set(self, key: str, schema_json: str) -> None:
+        """Store schema JSON under key, replacing any previous entry."""
+        with closing(self._connect()) as conn, conn:
+            conn.execute(
+                "INSERT OR REPLACE INTO schemas (key, schema_json, created) VALUES (?, ?, ?)",
+                (key, schema_json, time.time()),
+            )
+    
+    def _connect(self) -> sqlite3.Connection:
+        """Open a short-lived connection so the cache is safe to use from any thread."""
+        return sqlite3.connect(self.db_path, timeout=10)